@@ -1,52 +1,52 @@
-import pandas as pd
+import time
 import numpy as np
-
-
-EDMONTON_TEMP = pd.read_csv("Edmonton Year Long Temperature.csv")
-MONTH_DICT = {'January': "01",
-              'February': "02",
-              'March': "03",
-              'April': "04",
-              'May': "05",
-              'June': "06",
-              'July': "07",
-              'August': "08",
-              'September': "09",
-              'October': "10",
-              'November': "11",
-              'December': "12"}
-
-
-# Date is a list in the form [Year, Month, Day, Hhour]
-def convert_date(date):
-    year, month, day, hour = date
-    cvt_month = MONTH_DICT[month]
-    cvt_day = str(day).zfill(2)
-    cvt_hour = str(hour).zfill(2)
-    return str(year) + "-" + cvt_month + "-" + cvt_day + " " + cvt_hour + ":00:00 MDT"
-
-
-def get_date_index(date):
-    cvt_date = convert_date(date)
-    index = EDMONTON_TEMP.index
-    condition = EDMONTON_TEMP["Date"] == cvt_date
-    return index[condition].tolist()[0]
+from weather import date_to_hour, get_date_index, get_temperatures
+from archive import ARCHIVE_PATH, get_archive
+from results import CompactSimulationResult, MemmapSimulationResult, SimulationResult
+from fusion import FUSION_METHODS
+from noise import NoiseStream
+from schedule import Schedule
+from metrics import RunMetrics
+from progress import PROGRESS_STEPS
+
+
+# Fraction of the distance to the steady state temperature covered in one step, with the heater and
+# ambient held over the step. Euler is only stable for step_size < 2 * tau, the exact zero-order-hold
+# discretization is stable for any step and RK4 applied to the same model is kept for comparison.
+def get_step_gain(integrator, step_size, tau):
+    a = step_size / tau
+    if integrator == "euler":
+        return a
+    elif integrator == "zoh":
+        return -np.expm1(-a)
+    elif integrator == "rk4":
+        return a - a ** 2 / 2 + a ** 3 / 6 - a ** 4 / 24
+    raise ValueError("Unknown integrator: " + str(integrator))
+
+
+# Steps per chunk of a run recorded as a summary
+SUMMARY_CHUNK_STEPS = 4096
 
 
 class Simulation:
     def __init__(self, start_date=None, end_date=None, num_sensors=5, K=25, tau=15,
-                 step_size=15, use_weighted_mean=False, P=1, I=0, D=0, ref=None, status="None"):
+                 step_size=15, use_weighted_mean=False, P=1, I=0, D=0, ref=None, status="None",
+                 clamp=None, integrator="euler", station=None, archive=ARCHIVE_PATH, fusion=None,
+                 seed=None):
 
         # Simulation Parameters
         self.K = K
         self.tau = tau
         self.step_size = step_size
         self.heater = 0
+        self.integrator = integrator
+        self.step_gain = get_step_gain(integrator, step_size, tau)
 
-        # Control Parameters
+        # Control Parameters, ref is a list of setpoints spread evenly over the run or a Schedule
         self.P = P
         self.I = I
         self.D = D
+        self.clamp = clamp
         if ref is None:
             self.ref = [20]
         else:
@@ -57,14 +57,31 @@ class Simulation:
             start_date = [2019, 'October', 6, 0]
         if end_date is None:
             end_date = [2020, 'October', 5, 23]
-        start_index = get_date_index(start_date)
-        end_index = get_date_index(end_date)
-        self.ambient_temp = np.flip(EDMONTON_TEMP["Temperature"].to_numpy()[end_index : start_index + 1])
+        self.start_hour = date_to_hour(start_date)
+        if station is not None:
+            self.ambient_temp = get_archive(archive).get_temperatures(station, start_date, end_date)
+        else:
+            start_index = get_date_index(start_date)
+            end_index = get_date_index(end_date)
+            self.ambient_temp = np.flip(get_temperatures()[end_index : start_index + 1])
 
         # Sensor Array Setup
         self.num_sensors = num_sensors
         self.use_weighted_mean = use_weighted_mean
         self.status = status
+        # How the readings of the sensors are combined, one of fusion.FUSION_METHODS. The default
+        # follows use_weighted_mean.
+        if fusion is None:
+            fusion = "weighted_mean" if use_weighted_mean else "mean"
+        if fusion not in FUSION_METHODS:
+            raise ValueError("Unknown fusion method: " + str(fusion))
+        self.fusion = fusion
+        self.fuse = FUSION_METHODS[fusion]
+
+        # Sensor noise and faults are drawn from a generator owned by the simulation, so the same
+        # seed replays the same run. Child seeds for parallel runs come from noise.spawn_seeds.
+        self.noise = NoiseStream(seed)
+        self.seed = self.noise.seed
 
     def get_background_temp(self, t):
         floor_idx = np.floor(t).astype(int)
@@ -72,42 +89,84 @@ class Simulation:
         fraction = (t - floor_idx) * (self.ambient_temp[ceil_idx] - self.ambient_temp[floor_idx])
         return self.ambient_temp[floor_idx] + fraction
 
+    # Outside temperature at the given step indices, interpolated linearly between the hourly values.
+    # Like the reference below it only depends on the step, so a run computes it per chunk up front.
+    def get_ambient_trace(self, steps):
+        step_range = int(3600 / self.step_size)
+        return np.interp(steps / step_range, np.arange(len(self.ambient_temp)), self.ambient_temp)
+
+    # Reference temperature at the given step indices, every value of a ref list is held for an equal
+    # share of the run
+    def get_reference_trace(self, steps):
+        if isinstance(self.ref, Schedule):
+            return self.ref.compile(self.start_hour, self.step_size, self.get_sim_len())[steps]
+        ref_freq = int(np.ceil(self.get_sim_len() / len(self.ref)))
+        return np.asarray(self.ref, dtype=float)[np.asarray(steps) // ref_freq]
+
+    # Per step change of the ambient within every hour, the hour after the last one is flat
+    def get_ambient_slopes(self):
+        step_range = int(3600 / self.step_size)
+        return np.append(np.diff(self.ambient_temp) / step_range, 0)
+
+    # Steps after the first at which the reference may change
+    def get_reference_changes(self):
+        sim_len = self.get_sim_len()
+        if isinstance(self.ref, Schedule):
+            return self.ref.compile_rle(self.start_hour, self.step_size, sim_len)[0][1:]
+        return np.arange(0, sim_len, int(np.ceil(sim_len / len(self.ref))))[1:]
+
     def update_temp(self, temp, background_temp):
-        d_temp = self.step_size * (-temp + self.K * self.heater + background_temp) / self.tau
+        if self.integrator == "euler":
+            d_temp = self.step_size * (-temp + self.K * self.heater + background_temp) / self.tau
+        else:
+            d_temp = self.step_gain * (-temp + self.K * self.heater + background_temp)
         return temp + d_temp
 
     def measure_temp(self, temp):
         # The TMP116 sensors have an accuracy of +-0.2°C
-        measurements = np.random.normal(temp, 0.2, self.num_sensors)
+        measurements = temp + 0.2 * self.noise.normal(self.num_sensors)
         if self.status == "Short":
             measurements[0] = 0
-        elif self.status == "Faulty Connection" and np.random.random() < 0.5:
-            measurements[0] = measurements[0] + 5 * np.random.random()
+        elif self.status == "Faulty Connection" and self.noise.random() < 0.5:
+            measurements[0] = measurements[0] + 5 * self.noise.random()
         elif self.status == "Overheated":
-            measurements[0] = measurements[0] + np.random.normal(5, 1)
-        if self.use_weighted_mean and len(measurements) > 1:
-            weights = []
-            for i in range(len(measurements)):
-                weight = 0
-                for j in range(len(measurements)):
-                    if i != j:
-                        weight += abs(measurements[i] - measurements[j])
-                weights.append(weight ** -2)
-            weights = np.array(weights) / np.sum(weights)
-            temp = np.sum(weights * measurements)
-        else:
-            temp = np.mean(measurements)
+            measurements[0] = measurements[0] + 5 + self.noise.normal()
+        temp = self.fuse(measurements)
         self.temp_buffer.append(temp)
 
+    # measure_temp for the room temperatures temps of several measurement ticks at once, returns
+    # the fused reading of every tick. The noise of all ticks is drawn in one call per kind and is
+    # the same as measure_temp draws tick by tick, except with status "Faulty Connection", where
+    # every tick takes two uniform samples instead of one or two.
+    def measure_temps(self, temps):
+        n = len(temps)
+        if self.status == "Overheated":
+            noise = self.noise.normal(n * (self.num_sensors + 1)).reshape(n, self.num_sensors + 1)
+            measurements = temps[:, None] + 0.2 * noise[:, :-1]
+            measurements[:, 0] = measurements[:, 0] + 5 + noise[:, -1]
+            return self.fuse(measurements)
+        measurements = temps[:, None] + 0.2 * self.noise.normal(n * self.num_sensors).reshape(n, self.num_sensors)
+        if self.status == "Short":
+            measurements[:, 0] = 0
+        elif self.status == "Faulty Connection":
+            uniforms = self.noise.random(2 * n).reshape(n, 2)
+            measurements[:, 0] = measurements[:, 0] + np.where(uniforms[:, 0] < 0.5, 5 * uniforms[:, 1], 0)
+        return self.fuse(measurements)
+
     def control(self, ref):
         self.m_temp = np.mean(self.temp_buffer)
         err = ref - self.m_temp
         self.int_err += err * self.control_freq
         der_err = (err - self.past_err) / self.control_freq
         g = self.P * err + self.I * self.int_err + self.D * der_err
-        u = np.clip(g, 0, 1)
+        u = min(max(g, 0), 1)
 
-        if u > 0.5:
+        # Outside of the clamp band the heater is driven fully on or off
+        if self.clamp is not None and err > self.clamp:
+            self.heater = 1
+        elif self.clamp is not None and err < -self.clamp:
+            self.heater = 0
+        elif u > 0.5:
             self.heater = 1
         else:
             self.heater = 0
@@ -115,12 +174,98 @@ class Simulation:
         self.past_err = err
         self.temp_buffer = []
 
-    def run_sim(self, initial_temp, measure_freq, control_freq):
-        time = []
-        outside_temperature = []
-        room_temperature = []
-        reference_temperature = []
-        measured_temperature = []
+    def get_sim_len(self):
+        step_range = int(3600 / self.step_size)
+        return step_range * (len(self.ambient_temp) - 1) + 1
+
+    # With record="summary" no traces are kept and the metrics of metrics.RunMetrics are returned
+    # instead, the run then only holds one chunk of steps at a time in either mode. record="compact"
+    # returns a results.CompactSimulationResult. record="memmap" writes the traces to .npy files in
+    # the directory path while the run goes and returns a results.MemmapSimulationResult mapping
+    # them, for runs whose traces do not fit in memory. trace=False only applies to an event mode
+    # run recorded as a trace, see run_events. A profiling.PhaseStats passed as stats collects where
+    # the time of a step mode run goes, an event mode run is timed as a whole per chunk ("events").
+    # A run reports to a progress.ProgressToken passed as progress after every chunk (every
+    # PROGRESS_STEPS steps when recording a trace) and stops there when it is cancelled, returning
+    # what it recorded so far.
+    def run_sim(self, initial_temp, measure_freq, control_freq, mode="step", trace=True, record="trace", path=None,
+                stats=None, progress=None):
+        if record not in ("trace", "summary", "compact", "memmap"):
+            raise ValueError("Unknown record mode: " + str(record))
+        if record == "memmap" and path is None:
+            raise ValueError("A memmap record needs the path of a directory for the traces")
+        if mode not in ("step", "event"):
+            raise ValueError("Unknown run mode: " + str(mode))
+        step_range = int(3600 / self.step_size)
+        if record == "summary":
+            metrics = RunMetrics(self.step_size)
+            for steps, outside, reference, room, measured, heater in self._mode_chunks(mode, initial_temp, measure_freq,
+                                                                                      control_freq, SUMMARY_CHUNK_STEPS,
+                                                                                      stats, progress):
+                start = time.perf_counter()
+                metrics.add(reference, np.asarray(room), np.asarray(heater))
+                if stats is not None:
+                    stats.add("metrics", time.perf_counter() - start)
+                    stats.wall_time += time.perf_counter() - start
+            return metrics.summary()
+        if record == "trace" and mode == "event" and not trace:
+            return self.run_events(initial_temp, measure_freq, control_freq, trace, stats, progress)
+        if record == "compact":
+            result = CompactSimulationResult(step_range, self.ambient_temp)
+        elif record == "memmap":
+            result = MemmapSimulationResult(path, self.get_sim_len())
+            result.truncate(0)
+        else:
+            result = SimulationResult(self.get_sim_len())
+            result.truncate(0)
+        chunk_steps = 10000 if progress is None else PROGRESS_STEPS
+        for chunk in self.iter_run(initial_temp, measure_freq, control_freq, chunk_steps, stats, progress, mode):
+            start = time.perf_counter()
+            result.extend(chunk)
+            if stats is not None:
+                stats.add("store", time.perf_counter() - start)
+                stats.wall_time += time.perf_counter() - start
+        if record == "memmap":
+            result.flush()
+        return result
+
+    # Runs the simulation like run_sim, but yields the traces as SimulationResult chunks of
+    # chunk_steps steps while they are produced, so memory is bounded by the chunk size. With
+    # chunk_steps=None the whole run is a single chunk. Event mode chunks end at the first event
+    # after chunk_steps steps, see _event_chunks. stats only covers the time spent in here.
+    # progress is updated after every chunk, a cancelled run ends after the chunk it is in.
+    def iter_run(self, initial_temp, measure_freq, control_freq, chunk_steps=10000, stats=None, progress=None,
+                 mode="step"):
+        step_range = int(3600 / self.step_size)
+        for steps, outside, reference, room, measured, heater in self._mode_chunks(mode, initial_temp, measure_freq,
+                                                                                  control_freq, chunk_steps, stats,
+                                                                                  progress):
+            start = time.perf_counter()
+            result = SimulationResult(len(steps))
+            result.time[:] = steps / step_range
+            result.outside_temperature[:] = outside
+            result.reference_temperature[:] = reference
+            result.room_temperature[:] = room
+            result.measured_temperature[:] = measured
+            result.heater_state[:] = heater
+            if stats is not None:
+                stats.add("chunk", time.perf_counter() - start)
+                stats.wall_time += time.perf_counter() - start
+            yield result
+
+    # The chunks of _run_chunks, or of _event_chunks in event mode
+    def _mode_chunks(self, mode, initial_temp, measure_freq, control_freq, chunk_steps, stats=None, progress=None):
+        if mode == "event":
+            return self._event_chunks(initial_temp, measure_freq, control_freq, chunk_steps, stats, progress)
+        elif mode == "step":
+            return self._run_chunks(initial_temp, measure_freq, control_freq, chunk_steps, stats, progress)
+        raise ValueError("Unknown run mode: " + str(mode))
+
+    # The stepping loop behind iter_run and the summary mode of run_sim. Yields the step indices,
+    # outside and reference temperature of every chunk as arrays and the room temperature, measured
+    # temperature and heater state as lists. The loop works on plain floats, which is quicker than
+    # indexing numpy arrays element by element and gives the same values.
+    def _run_chunks(self, initial_temp, measure_freq, control_freq, chunk_steps, stats=None, progress=None):
         temp = initial_temp
         self.m_temp = initial_temp
 
@@ -129,39 +274,238 @@ class Simulation:
         self.int_err = 0
         self.past_err = 0
 
-        step_range = int(3600 / self.step_size)
-        sim_len = step_range * (len(self.ambient_temp) - 1) + 1
-        ref_freq = int(np.ceil(sim_len / len(self.ref)))
-        r_idx = 0
-        ref = self.ref[r_idx]
-
-        for s in range(sim_len):
-            t = s / step_range
+        sim_len = self.get_sim_len()
+        ref = self.get_reference_trace(0)
+
+        if chunk_steps is None:
+            chunk_steps = sim_len
+
+        for chunk_start in range(0, sim_len, chunk_steps):
+            steps = np.arange(chunk_start, min(chunk_start + chunk_steps, sim_len))
+            if stats is None:
+                outside = self.get_ambient_trace(steps)
+                reference = self.get_reference_trace(steps)
+                temp, ref, room, measured, heater = self._steps(temp, ref, steps, outside, reference,
+                                                                measure_freq, control_freq)
+            else:
+                start = time.perf_counter()
+                outside = self.get_ambient_trace(steps)
+                ambient_end = time.perf_counter()
+                reference = self.get_reference_trace(steps)
+                stats.add("ambient", ambient_end - start)
+                stats.add("reference", time.perf_counter() - ambient_end)
+                temp, ref, room, measured, heater = self._timed_steps(temp, ref, steps, outside, reference,
+                                                                      measure_freq, control_freq, stats)
+                stats.wall_time += time.perf_counter() - start
+            yield steps, outside, reference, room, measured, heater
+            if progress is not None and progress.update(steps[-1] + 1, sim_len):
+                return
+
+    # Steps through one chunk from temp, returns the state to carry on with and the traces
+    def _steps(self, temp, ref, steps, outside, reference, measure_freq, control_freq):
+        room = []
+        measured = []
+        heater = []
+        for s, background_temp, step_ref in zip(steps.tolist(), outside.tolist(), reference.tolist()):
+            temp = self.update_temp(temp, background_temp)
 
-            background_temp = self.get_background_temp(t)
+            if s % measure_freq == 0:
+                self.measure_temp(temp)
+            # The controller acts on the reference of the previous step, a new reference value
+            # is recorded at its first step but only used from the next control tick on
+            if s % control_freq == 0:
+                self.control(ref)
+            ref = step_ref
+
+            room.append(temp)
+            measured.append(self.m_temp)
+            heater.append(self.heater)
+        return temp, ref, room, measured, heater
+
+    # _steps with the time of every measurement and control tick added to stats, and the times of
+    # every sample_every-th model update and recording of a step as samples
+    def _timed_steps(self, temp, ref, steps, outside, reference, measure_freq, control_freq, stats):
+        clock = time.perf_counter
+        sample_every = stats.sample_every
+        measure_time = control_time = 0.0
+        measure_calls = control_calls = 0
+        update_samples = []
+        record_samples = []
+        room = []
+        measured = []
+        heater = []
+        for s, background_temp, step_ref in zip(steps.tolist(), outside.tolist(), reference.tolist()):
+            timed = s % sample_every == 0
+            if timed:
+                start = clock()
             temp = self.update_temp(temp, background_temp)
+            if timed:
+                update_samples.append(clock() - start)
 
             if s % measure_freq == 0:
+                start = clock()
                 self.measure_temp(temp)
+                measure_time += clock() - start
+                measure_calls += 1
             if s % control_freq == 0:
+                start = clock()
                 self.control(ref)
-            if s % ref_freq == 0 and s != 0:
-                r_idx += 1
-                ref = self.ref[r_idx]
-
-            time.append(t)
-            room_temperature.append(temp)
-            outside_temperature.append(background_temp)
-            reference_temperature.append(ref)
-            measured_temperature.append(self.m_temp)
-        return time, room_temperature, outside_temperature, reference_temperature, measured_temperature
-
-    def calibrate(self, control_freq):
+                control_time += clock() - start
+                control_calls += 1
+            ref = step_ref
+
+            if timed:
+                start = clock()
+            room.append(temp)
+            measured.append(self.m_temp)
+            heater.append(self.heater)
+            if timed:
+                record_samples.append(clock() - start)
+        stats.add_samples("update_temp", update_samples, len(room))
+        stats.add("measure_temp", measure_time, measure_calls)
+        stats.add("control", control_time, control_calls)
+        stats.add_samples("record", record_samples, len(room))
+        return temp, ref, room, measured, heater
+
+    # Room temperatures k steps after step p - 1 (k >= 1, a number or an array) starting from temp
+    # at step p - 1, with the heater held at heater and the ambient changing by slope per step from
+    # its value at step p (see get_ambient_slopes). Both hold within an hour, so the first order model
+    # is solved exactly instead of taking Euler steps.
+    def exact_temp(self, temp, p, k, heater, slope):
+        step_range = int(3600 / self.step_size)
+        hour = p // step_range
+        background_temp = self.ambient_temp[hour] + slope * (p - hour * step_range)
+        steady_temp = self.K * heater + background_temp - slope * self.tau / self.step_size
+        return steady_temp + slope * k + (temp - steady_temp) * np.exp(-k * self.step_size / self.tau)
+
+    # Event driven version of run_sim recording a trace. With trace=False the result only holds the
+    # event ticks, see _event_chunks.
+    def run_events(self, initial_temp, measure_freq, control_freq, trace=True, stats=None, progress=None):
+        step_range = int(3600 / self.step_size)
+        steps, outside, reference, room, measured, heater = next(self._event_chunks(initial_temp, measure_freq,
+                                                                                    control_freq, None, stats,
+                                                                                    progress, trace))
+        return SimulationResult.from_arrays({'time': steps / step_range,
+                                             'room_temperature': room,
+                                             'outside_temperature': outside,
+                                             'reference_temperature': reference,
+                                             'measured_temperature': measured,
+                                             'heater_state': heater})
+
+    # The loop of the event mode, yielding chunks like _run_chunks. Only the control ticks, the
+    # reference changes and the last step of every hour are visited one by one; in between the
+    # heater, the reference and the slope of the ambient hold. The room temperature of a whole
+    # segment comes from one exact_temp call and the measurement ticks in it are taken together with
+    # measure_temps, before the control tick that ends the segment like in step mode. The measured
+    # temperature and heater state only change at control ticks, so they are filled in per chunk from
+    # their values at the events. A chunk ends at the first event at least chunk_steps steps after it
+    # starts (all of the run with chunk_steps=None). With trace=False the chunks only hold the rows
+    # of the events. stats gets the time of every chunk as the phase "events", progress is updated
+    # after every chunk.
+    def _event_chunks(self, initial_temp, measure_freq, control_freq, chunk_steps=None, stats=None, progress=None,
+                      trace=True):
+        temp = initial_temp
+        self.m_temp = initial_temp
+
+        self.control_freq = control_freq
+        self.temp_buffer = []
+        self.int_err = 0
+        self.past_err = 0
+
+        step_range = int(3600 / self.step_size)
+        sim_len = self.get_sim_len()
+        ref = self.get_reference_trace(0)
+        if chunk_steps is None:
+            chunk_steps = sim_len
+
+        slopes = self.get_ambient_slopes().tolist()
+        # Events are at most a control period and at most an hour apart
+        offsets = np.arange(1, min(control_freq, step_range) + 1)
+
+        chunk_start = 0
+        chunk_time = time.perf_counter()
+        rows = []
+        rooms = []
+        values = [(ref, self.m_temp, self.heater)]
+        past_e = -1
+        for e, next_ref in self._events(control_freq, chunk_steps):
+            p = past_e + 1
+            n = e - past_e
+            slope = slopes[p // step_range]
+            # Offset of the first measurement tick in the segment
+            first = -p % measure_freq
+            if trace:
+                segment = self.exact_temp(temp, p, offsets[:n], self.heater, slope)
+                rooms.append(segment)
+                if first < n:
+                    self.temp_buffer.extend(self.measure_temps(segment[first::measure_freq]).tolist())
+                temp = segment[-1]
+            else:
+                if first < n:
+                    ticks = self.exact_temp(temp, p, offsets[first:n:measure_freq], self.heater, slope)
+                    self.temp_buffer.extend(self.measure_temps(ticks).tolist())
+                temp = self.exact_temp(temp, p, n, self.heater, slope)
+                rooms.append(temp)
+
+            if e % control_freq == 0:
+                self.control(ref)
+            ref = next_ref
+            rows.append(e)
+            values.append((ref, self.m_temp, self.heater))
+            past_e = e
+
+            if e + 1 - chunk_start >= chunk_steps or e == sim_len - 1:
+                reference, measured, heater = (np.array(v) for v in zip(*values))
+                if trace:
+                    steps = np.arange(chunk_start, e + 1)
+                    # Every value holds from its event to the next, the first one from the chunk start
+                    lengths = np.diff(np.array([chunk_start] + rows + [e + 1]))
+                    reference, measured, heater = (np.repeat(v, lengths) for v in (reference, measured, heater))
+                    room = np.concatenate(rooms)
+                else:
+                    steps = np.array(rows)
+                    reference, measured, heater = reference[1:], measured[1:], heater[1:]
+                    room = np.array(rooms)
+                outside = self.get_ambient_trace(steps)
+                if stats is not None:
+                    stats.add("events", time.perf_counter() - chunk_time, len(rows))
+                    stats.wall_time += time.perf_counter() - chunk_time
+                yield steps, outside, reference, room, measured, heater.astype(np.int8)
+                if progress is not None and progress.update(e + 1, sim_len):
+                    return
+                chunk_time = time.perf_counter()
+                chunk_start = e + 1
+                rows = []
+                rooms = []
+                values = values[-1:]
+
+    # The events of _event_chunks in order with the reference from each on: the control ticks, the
+    # reference changes and the last step of every hour and of the run. They are worked out window
+    # steps at a time, so a long run never holds all of them.
+    def _events(self, control_freq, window):
+        step_range = int(3600 / self.step_size)
+        sim_len = self.get_sim_len()
+        changes = self.get_reference_changes()
+        for start in range(0, sim_len, window):
+            stop = min(start + window, sim_len)
+            events = np.union1d(np.arange(-(-start // control_freq) * control_freq, stop, control_freq),
+                                changes[(changes >= start) & (changes < stop)])
+            hour_end = start + (step_range - 1 - start) % step_range
+            events = np.union1d(events, np.arange(hour_end, stop, step_range))
+            if stop == sim_len:
+                events = np.union1d(events, [sim_len - 1])
+            yield from zip(events.tolist(), self.get_reference_trace(events).tolist())
+
+    # A profiling.PhaseStats passed as stats gets the time of the simulated steps ("rollout") and of
+    # the gain updates between them. progress is updated after every round and a cancelled
+    # calibration returns the best gains found so far.
+    def calibrate(self, control_freq, stats=None, progress=None):
         pid = [0, 0, 0]
         best_pid = pid
         smallest_err = np.inf
 
         for i in range(100):
+            start = time.perf_counter()
 
             # Errors
             int_err = 0
@@ -215,14 +559,16 @@ class Simulation:
                 past_grad = grads[2]
 
                 tracking_err += abs(err)
-                if np.random.random() > 0.1:
+                if self.noise.random() > 0.1:
                     err_grads[0] = err_grads[0] + err * grads[0] / np.sqrt(1 + err ** 2)
                     err_grads[1] = err_grads[1] + err * grads[1] / np.sqrt(1 + err ** 2)
                     err_grads[2] = err_grads[2] + err * grads[2] / np.sqrt(1 + err ** 2)
 
-                b_temp = 10 + np.random.normal(0, 0.2)
+                b_temp = 10 + 0.2 * self.noise.normal()
                 temp = self.update_temp(temp, b_temp)
 
+            rollout_end = time.perf_counter()
+
             # Update pids
             new_pid = [0, 0, 0]
             new_pid[0] = np.clip(pid[0] + 5e-3 * err_grads[0] / step_range, pid[0] - 1, pid[0] + 1)
@@ -232,4 +578,10 @@ class Simulation:
             if tracking_err < smallest_err:
                 best_pid = pid
                 smallest_err = tracking_err
+            if stats is not None:
+                stats.add("rollout", rollout_end - start, step_range)
+                stats.add("update", time.perf_counter() - rollout_end)
+                stats.wall_time += time.perf_counter() - start
+            if progress is not None and progress.update(i + 1, 100):
+                break
         return best_pid
\ No newline at end of file
@@ -1,9 +1,18 @@
 from tkinter import *
 from tkinter import ttk
 import seaborn as sns
-import threading
-import pandas as pd
+import shutil
+import tempfile
+import time
 import numpy as np
+from weather import date_to_hour, get_date_index, get_temperatures, get_years
+from results import MemmapSimulationResult, SharedSimulationResult, SimulationResult, save_result
+from decimate import DecimatedPlot, envelope_decimate
+from liveplot import LivePlot
+from fusion import weighted_mean
+from progress import PROGRESS_STEPS
+from schedule import Schedule
+from worker import SimulationWorker
 from matplotlib import pyplot as plt
 from matplotlib.backends.backend_tkagg import (
     FigureCanvasTkAgg, NavigationToolbar2Tk)
@@ -12,38 +21,12 @@ fontP = FontProperties()
 fontP.set_size('small')
 sns.set()
 
+# Runs longer than this many steps are recorded into memory mapped files instead of memory
+MEMMAP_STEPS = 5000000
+
 
 SIG = 100
 SIG_BOUND = 10 / SIG
-EDMONTON_TEMP = pd.read_csv("Edmonton Year Long Temperature.csv")
-MONTH_DICT = {'January': "01",
-              'February': "02",
-              'March': "03",
-              'April': "04",
-              'May': "05",
-              'June': "06",
-              'July': "07",
-              'August': "08",
-              'September': "09",
-              'October': "10",
-              'November': "11",
-              'December': "12"}
-
-
-# Date is a list in the form [Year, Month, Day, Hhour]
-def convert_date(date):
-    year, month, day, hour = date
-    cvt_month = MONTH_DICT[month]
-    cvt_day = str(day).zfill(2)
-    cvt_hour = str(hour).zfill(2)
-    return str(year) + "-" + cvt_month + "-" + cvt_day + " " + cvt_hour + ":00:00 MDT"
-
-
-def get_date_index(date):
-    cvt_date = convert_date(date)
-    index = EDMONTON_TEMP.index
-    condition = EDMONTON_TEMP["Date"] == cvt_date
-    return index[condition].tolist()[0]
 
 
 def sigmoid(x):
@@ -73,15 +56,12 @@ def d2sig(x):
 
 class Root(Tk):
     def __init__(self):
-        global progress_bar_value, progress_bar_text, update_plot, is_thread_running, cancel_calibrate, cancel_sim
+        global update_plot
         super(Root, self).__init__()
         self.title("Temperature Simulator")
         self.minsize(800, 675)
 
         update_plot = True
-        is_thread_running = False
-        cancel_calibrate = False
-        cancel_sim = False
         self.fig = plt.figure(figsize=(8, 6), dpi=100)
         self.canvas = FigureCanvasTkAgg(figure=self.fig, master=self)
         self.canvas.get_tk_widget().grid(column=1,
@@ -147,6 +127,12 @@ class Root(Tk):
         self.plot_measure.set(False)
         self.status = StringVar()
         self.status.set("None")
+        self.ensemble_size = StringVar()
+        self.ensemble_size.set(0)
+        self.ensemble_seed = StringVar()
+        self.ensemble_seed.set(0)
+        self.profile = BooleanVar()
+        self.profile.set(False)
         self.csv_path = StringVar()
         self.csv_path.set("Temperature_Data.csv")
         self.use_temp = BooleanVar()
@@ -155,15 +141,18 @@ class Root(Tk):
         self.outside_temp.set("-5,5")
         self.clamp = StringVar()
         self.clamp.set("1")
-        progress_bar_value = 0
-        progress_bar_text = ""
 
-        self.time = [1]
-        self.r_temp = [0]
-        self.o_temp = [0]
-        self.ref_temp = [0]
-        self.m_temp = [0]
-        self.u = [0]
+        self.result = SimulationResult(1)
+        self.result.time[0] = 1
+        self.result_dir = None
+        self.live_plot = None
+        self.ensemble = None
+        # progress.ProgressToken of the running simulation or calibration, None while idle
+        self.job = None
+        self.job_progress = 0
+        # Runs and calibrations go to a worker process, see update_ui for its messages
+        self.worker = SimulationWorker(Simulation)
+        self.protocol("WM_DELETE_WINDOW", self.close_window)
 
         # Simulation Parameters Frame
         self.sim_parameter_frame = ttk.LabelFrame(self,
@@ -205,7 +194,7 @@ class Root(Tk):
                                    pady=20)
         self.is_calibrate_button_cancel = False
 
-        # Save Data to .csv File
+        # Save Data to a .csv, .npz, .parquet or .feather File (by the extension of the path)
         self.csv_button = Button(self,
                                  text="Save Data",
                                  command=self.save_data)
@@ -244,7 +233,38 @@ class Root(Tk):
                                       self.status,
                                       *["None", "Short", "Faulty Connection", "Overheated"])
         self.status_menu.grid(column=0,
+                              columnspan=2,
                               row=0)
+        self.ensemble_size_label = Label(self.status_frame,
+                                         text="ensemble runs")
+        self.ensemble_size_label.grid(column=0,
+                                      row=1,
+                                      padx=5,
+                                      pady=5)
+        self.ensemble_size_entry = Entry(self.status_frame,
+                                         textvariable=self.ensemble_size,
+                                         width=10,
+                                         justify="center")
+        self.ensemble_size_entry.grid(column=1,
+                                      row=1)
+        self.ensemble_seed_label = Label(self.status_frame,
+                                         text="ensemble seed")
+        self.ensemble_seed_label.grid(column=0,
+                                      row=2,
+                                      padx=5,
+                                      pady=5)
+        self.ensemble_seed_entry = Entry(self.status_frame,
+                                         textvariable=self.ensemble_seed,
+                                         width=10,
+                                         justify="center")
+        self.ensemble_seed_entry.grid(column=1,
+                                      row=2)
+        self.profile_check = Checkbutton(self.status_frame,
+                                         text="print phase timings",
+                                         variable=self.profile)
+        self.profile_check.grid(column=0,
+                                columnspan=2,
+                                row=3)
 
         # Plot Parameters
         self.plot_frame = ttk.LabelFrame(self,
@@ -263,9 +283,9 @@ class Root(Tk):
         self.progress_bar.grid(column=1,
                                columnspan=2,
                                row=8)
-        self.progress_bar['value'] = progress_bar_value
+        self.progress_bar['value'] = 0
         self.progress_bar_label = Label(self)
-        self.progress_bar_label['text'] = progress_bar_text
+        self.progress_bar_label['text'] = ""
         self.progress_bar_label.grid(column=1,
                                      columnspan=2,
                                      row=7)
@@ -361,13 +381,13 @@ class Root(Tk):
 
         self.start_year_menu = OptionMenu(self.date_frame,
                                           self.start_year,
-                                          *[2019, 2020])
+                                          *get_years())
         self.start_year_menu.grid(column=1,
                                   row=0)
 
         self.end_year_menu = OptionMenu(self.date_frame,
                                         self.end_year,
-                                        *[2019, 2020])
+                                        *get_years())
         self.end_year_menu.grid(column=1,
                                 row=1)
 
@@ -565,128 +585,202 @@ class Root(Tk):
                             row=5)
 
     def run_sim(self):
-        global is_thread_running, cancel_sim
         if self.is_run_sim_button_cancel:
-            cancel_sim = True
-        elif not is_thread_running:
+            self.job.cancel()
+        elif self.job is None:
             start_date = [int(self.start_year.get()), self.start_month.get(),
                           int(self.start_day.get()), int(self.start_hour.get())]
             end_date = [int(self.end_year.get()), self.end_month.get(),
                         int(self.end_day.get()), int(self.end_hour.get())]
 
-            ref_str = self.ref.get().split(",")
-            ref = [float(i) for i in ref_str]
+            # A comma list of setpoints spread over the run, or a schedule such as
+            # "17; weekdays 07:00-22:00 21; weekends 09:00-23:00 20" (see Schedule.parse)
+            ref_text = self.ref.get()
+            if any(c.isalpha() or c == ";" for c in ref_text):
+                ref = Schedule.parse(ref_text)
+            else:
+                ref = [float(i) for i in ref_text.split(",")]
 
             out_str = self.outside_temp.get().split(",")
             out_temp = [float(i) for i in out_str]
 
-            sim = Simulation(start_date=start_date, end_date=end_date,
-                             K=float(self.K.get()), tau=float(self.tau.get()),
-                             step_size=int(self.step_size.get()),
-                             P=float(self.P.get()), I=float(self.I.get()),
-                             D=float(self.D.get()), ref=ref, clamp = float(self.clamp.get()),
-                             use_weighted_mean=self.use_weighted_mean.get(),
-                             status=self.status.get(), use_data=self.use_temp.get(),
-                             outside_temps=out_temp)
-            t = threading.Thread(target=self.run_sim_thread,
-                             args=(sim,
-                                   float(self.initial_temp.get()),
-                                   int(self.measure_freq.get()),
-                                   int(self.control_freq.get()),),
-                             daemon=True)
-            t.start()
-
-    def run_sim_thread(self, sim, initial_temp, measure_freq, control_freq):
-        global update_plot, is_thread_running, cancel_sim
-        is_thread_running = True
-        self.run_sim_button['text'] = "Cancel"
-        self.is_run_sim_button_cancel = True
-
-        self.time, self.r_temp, self.o_temp, self.ref_temp, \
-        self.m_temp, self.u = sim.run_sim(initial_temp=initial_temp,
-                                          measure_freq=measure_freq,
-                                          control_freq=control_freq)
-
-        self.run_sim_button['text'] = "Run Simulation"
-        self.is_run_sim_button_cancel = False
-        is_thread_running = False
-        cancel_sim = False
-        update_plot = True
+            sim_args = dict(start_date=start_date, end_date=end_date,
+                            K=float(self.K.get()), tau=float(self.tau.get()),
+                            step_size=int(self.step_size.get()),
+                            P=float(self.P.get()), I=float(self.I.get()),
+                            D=float(self.D.get()), ref=ref, clamp = float(self.clamp.get()),
+                            use_weighted_mean=self.use_weighted_mean.get(),
+                            status=self.status.get(), use_data=self.use_temp.get(),
+                            outside_temps=out_temp)
+            sim = Simulation(**sim_args)
+            self.ensemble = None
+            self.result = self.new_result(sim.get_sim_len())
+            self.result.truncate(0)
+            self.start_live_plot(sim, float(self.initial_temp.get()))
+            # The worker follows the run with ensemble_size realizations of the same configuration,
+            # whose room temperature is shown as percentile bands once the run is done. The same
+            # ensemble seed gives the same bands.
+            self.job = self.worker.run(self.result, sim_args,
+                                       int(self.ensemble_size.get()),
+                                       float(self.initial_temp.get()),
+                                       int(self.measure_freq.get()),
+                                       int(self.control_freq.get()),
+                                       self.profile.get(),
+                                       int(self.ensemble_seed.get()))
+            self.run_sim_button['text'] = "Cancel"
+            self.is_run_sim_button_cancel = True
+
+    # Empty result for the worker to fill with a run of sim_len steps. Long runs go to a temporary
+    # directory, the others to shared memory, either replaces the result of the previous run.
+    def new_result(self, sim_len):
+        self.free_result()
+        if sim_len <= MEMMAP_STEPS:
+            return SharedSimulationResult(sim_len)
+        self.result_dir = tempfile.mkdtemp(prefix="temperature-sim-")
+        return MemmapSimulationResult(self.result_dir, sim_len)
+
+    # Unlinks the shared memory or removes the directory of the result of the last run
+    def free_result(self):
+        if isinstance(self.result, SharedSimulationResult):
+            self.result.close()
+        if self.result_dir is not None:
+            shutil.rmtree(self.result_dir, ignore_errors=True)
+            self.result_dir = None
+
+    # Cancels a running job, ends the worker and frees the result, when the window is closed and
+    # when the main loop ends otherwise. Shutting down again does nothing.
+    def shutdown(self):
+        if self.job is not None:
+            self.job.cancel()
+        self.worker.close()
+        if self.job is not None:
+            self.job.close()
+            self.job = None
+        self.free_result()
+
+    def close_window(self):
+        self.shutdown()
+        self.destroy()
 
     def calibrate(self):
-        global is_thread_running, cancel_calibrate
         if self.is_calibrate_button_cancel:
-            cancel_calibrate = True
-        elif not is_thread_running:
-            sim = Simulation(K=float(self.K.get()), tau=float(self.tau.get()),
-                             step_size=int(self.step_size.get()),
-                             P=float(self.P.get()), I=float(self.I.get()),
-                             D=float(self.D.get()), clamp=float(self.clamp.get()))
-            t = threading.Thread(target=self.calibrate_thread,
-                                 args=(sim, int(self.control_freq.get()),),
-                                 daemon=True)
-            t.start()
-
-    def calibrate_thread(self, sim, control_freq):
-        global is_thread_running, cancel_calibrate
-        is_thread_running = True
-        self.calibrate_button['text'] = "Cancel"
-        self.is_calibrate_button_cancel = True
-
-        pid = sim.calibrate(control_freq)
-        self.P.set(round(pid[0], 6))
-        self.I.set(round(pid[1], 6))
-        self.D.set(round(pid[2], 6))
-
-        self.calibrate_button['text'] = "Calibrate"
-        self.is_calibrate_button_cancel = False
-        is_thread_running = False
-        cancel_calibrate = False
-
-
-    def plot_data(self, time, temp, b_temp, r_temp, m_temp):
-        global update_plot
-        plt.cla()
+            self.job.cancel()
+        elif self.job is None:
+            sim_args = dict(K=float(self.K.get()), tau=float(self.tau.get()),
+                            step_size=int(self.step_size.get()),
+                            P=float(self.P.get()), I=float(self.I.get()),
+                            D=float(self.D.get()), clamp=float(self.clamp.get()))
+            self.job = self.worker.calibrate(sim_args, int(self.control_freq.get()))
+            self.calibrate_button['text'] = "Cancel"
+            self.is_calibrate_button_cancel = True
+
+    def get_plot_lines(self):
+        lines = []
         if self.plot_outside.get():
-            plt.plot(time, b_temp, 'b', label='Outside', linestyle='--')
+            lines.append(('outside_temperature', 'b', dict(label='Outside', linestyle='--')))
         if self.plot_ref.get():
-            plt.plot(time, r_temp, 'r', label='Reference', linewidth=2, linestyle=':')
+            lines.append(('reference_temperature', 'r', dict(label='Reference', linewidth=2, linestyle=':')))
         if self.plot_measure.get():
-            plt.plot(time, m_temp, 'g', label='Measured', linewidth=0.75, linestyle='-.')
+            lines.append(('measured_temperature', 'g', dict(label='Measured', linewidth=0.75, linestyle='-.')))
         if self.plot_room.get():
-            plt.plot(time, temp, 'k', label='Room', linewidth=0.5)
-        plt.xlim(0, time[-1])
+            lines.append(('room_temperature', 'k', dict(label='Room', linewidth=0.5)))
+        return lines
+
+    def start_live_plot(self, sim, initial_temp):
+        plt.cla()
+        refs = sim.ref.temperatures() if isinstance(sim.ref, Schedule) else sim.ref
+        temps = np.concatenate((sim.ambient_temp, refs, [initial_temp]))
+        self.live_plot = LivePlot(self.canvas, plt.gca(), self.result, self.get_plot_lines(),
+                                  x_max=len(sim.ambient_temp) - 1,
+                                  y_lim=(temps.min() - 1, temps.max() + 1))
+        plt.xlabel('Time [h]')
+        plt.ylabel('Temperature [°C]')
+        plt.legend(bbox_to_anchor=(0.5, 1.1), loc='upper center', ncol=4, prop=fontP)
+        self.canvas.draw()
+
+    def plot_data(self, result):
+        global update_plot
+        if self.live_plot is not None:
+            self.live_plot.stop()
+            self.live_plot = None
+        plt.cla()
+        self.decimated_plot = DecimatedPlot(plt.gca())
+        for name, fmt, kwargs in self.get_plot_lines():
+            self.decimated_plot.plot(result.time, getattr(result, name), fmt, **kwargs)
+        if self.ensemble is not None and self.ensemble.time[-1] == result.time[-1]:
+            self.plot_ensemble(self.ensemble)
+        plt.xlim(0, result.time[-1])
         plt.xlabel('Time [h]')
         plt.ylabel('Temperature [°C]')
         plt.legend(bbox_to_anchor=(0.5, 1.1), loc='upper center', ncol=4, prop=fontP)
         self.canvas.draw()
         update_plot = False
 
+    # Shades the bands between the outer and the inner pairs of percentiles of the ensemble
+    def plot_ensemble(self, ensemble):
+        ax = plt.gca()
+        num_buckets = max(int(ax.bbox.width), 1)
+        percentiles = ensemble.percentiles
+        for i in range(len(percentiles) // 2):
+            x, lower, upper = envelope_decimate(ensemble.time, ensemble.bands[i], ensemble.bands[-1 - i], num_buckets)
+            ax.fill_between(x, lower, upper, color='k', alpha=0.15, linewidth=0,
+                            label=str(percentiles[i]) + "-" + str(percentiles[-1 - i]) + "%")
+
     def save_data(self):
-        data_dict = {
-            'Time [h]': self.time,
-            'Room Temperature [°C]': self.r_temp,
-            'Reference Temperature [°C]': self.ref_temp,
-            'Outside Temperature [°C]': self.o_temp,
-            'Measured Temperature [°C]': self.m_temp,
-            'Heater State [On/Off]': self.u
-        }
-        df = pd.DataFrame(data_dict)
-        df.to_csv(self.csv_path.get(), index=False)
+        save_result(self.result, self.csv_path.get())
+
+    # Applies a message of the worker (see worker.SimulationWorker). Widgets are only ever
+    # changed here on the Tk thread.
+    def handle_message(self, message):
+        global update_plot
+        if message[0] == "progress":
+            self.job_progress, length = message[1:]
+            if length is not None:
+                self.result.length = length
+            return
+
+        kind, payload = message[1:]
+        self.job.close()
+        self.job = None
+        self.job_progress = 0
+        if message[0] == "error":
+            print(payload)
+        if kind == "run":
+            if message[0] == "done":
+                self.result.length = payload["length"]
+                self.ensemble = payload["ensemble"]
+                if payload["stats"] is not None:
+                    print(payload["stats"])
+            self.run_sim_button['text'] = "Run Simulation"
+            self.is_run_sim_button_cancel = False
+            update_plot = True
+        else:
+            if message[0] == "done":
+                pid = payload
+                self.P.set(round(pid[0], 6))
+                self.I.set(round(pid[1], 6))
+                self.D.set(round(pid[2], 6))
+            self.calibrate_button['text'] = "Calibrate"
+            self.is_calibrate_button_cancel = False
 
     def update_ui(self):
-        global progress_bar_value, progress_bar_text, update_plot
-        self.progress_bar['value'] = progress_bar_value
-        self.progress_bar_label['text'] = progress_bar_text
+        global update_plot
+        for message in self.worker.poll():
+            self.handle_message(message)
+        job = self.job
+        self.progress_bar['value'] = 0 if job is None else int(100 * self.job_progress)
+        self.progress_bar_label['text'] = "" if job is None else job.text
         if update_plot:
-            self.plot_data(self.time, self.r_temp, self.o_temp, self.ref_temp, self.m_temp)
+            self.plot_data(self.result)
+        elif self.live_plot is not None:
+            self.live_plot.update()
         root.after(100, self.update_ui)
 
 
 class Simulation:
     def __init__(self, start_date=None, end_date=None, num_sensors=5, K=25.0, tau=15.0,
                  step_size=15, use_weighted_mean=False, P=1.0, I=0.0, D=0.0, ref=None, status="None",
-                 use_data=True, outside_temps=None, clamp=1.0):
+                 use_data=True, outside_temps=None, clamp=1.0, seed=None):
 
         # Simulation Parameters
         self.K = K
@@ -710,12 +804,13 @@ class Simulation:
             start_date = [2019, 'October', 6, 0]
         if end_date is None:
             end_date = [2020, 'October', 5, 23]
+        self.start_hour = date_to_hour(start_date)
         if outside_temps is None:
             outside_temps = [-5, 5]
         start_index = get_date_index(start_date)
         end_index = get_date_index(end_date)
         if use_data:
-            self.ambient_temp = np.flip(EDMONTON_TEMP["Temperature"].to_numpy()[end_index : start_index + 1])
+            self.ambient_temp = np.flip(get_temperatures()[end_index : start_index + 1])
         else:
             num_temps = len(outside_temps)
             num_indices = start_index - end_index
@@ -730,35 +825,42 @@ class Simulation:
         self.use_weighted_mean = use_weighted_mean
         self.status = status
 
+        # Sensor noise is drawn from a generator of the simulation, seeded with seed (any seed
+        # np.random.default_rng takes, e.g. a child of noise.spawn_seeds), so a seeded run replays
+        self.rng = np.random.default_rng(seed)
+
     def get_background_temp(self, t):
         floor_idx = np.floor(t).astype(int)
         ceil_idx = np.ceil(t).astype(int)
         fraction = (t - floor_idx) * (self.ambient_temp[ceil_idx] - self.ambient_temp[floor_idx])
         return self.ambient_temp[floor_idx] + fraction
 
+    # Outside and reference temperature at the given step indices, computed per chunk up front
+    def get_ambient_trace(self, steps):
+        step_range = int(3600 / self.step_size)
+        return np.interp(steps / step_range, np.arange(len(self.ambient_temp)), self.ambient_temp)
+
+    def get_reference_trace(self, steps):
+        if isinstance(self.ref, Schedule):
+            return self.ref.compile(self.start_hour, self.step_size, self.get_sim_len())[steps]
+        ref_freq = int(np.ceil(self.get_sim_len() / len(self.ref)))
+        return np.asarray(self.ref, dtype=float)[np.asarray(steps) // ref_freq]
+
     def update_temp(self, temp, background_temp):
         d_temp = self.step_size * (-temp + self.K * self.heater + background_temp) / self.tau
         return temp + d_temp
 
     def measure_temp(self, temp):
         # The TMP116 sensors have an accuracy of +-0.2°C
-        measurements = np.random.normal(temp, 0.2, self.num_sensors)
+        measurements = self.rng.normal(temp, 0.2, self.num_sensors)
         if self.status == "Short":
             measurements[0] = 0
-        elif self.status == "Faulty Connection" and np.random.random() < 0.5:
-            measurements[0] = measurements[0] + 5 * np.random.random()
+        elif self.status == "Faulty Connection" and self.rng.random() < 0.5:
+            measurements[0] = measurements[0] + 5 * self.rng.random()
         elif self.status == "Overheated":
-            measurements[0] = measurements[0] + np.random.normal(5, 1)
-        if self.use_weighted_mean and len(measurements) > 1:
-            weights = []
-            for i in range(len(measurements)):
-                weight = 0
-                for j in range(len(measurements)):
-                    if i != j:
-                        weight += abs(measurements[i] - measurements[j])
-                weights.append(weight ** -2)
-            weights = np.array(weights) / np.sum(weights)
-            m_temp = np.sum(weights * measurements)
+            measurements[0] = measurements[0] + self.rng.normal(5, 1)
+        if self.use_weighted_mean:
+            m_temp = weighted_mean(measurements)
         else:
             m_temp = np.mean(measurements)
         self.temp_buffer.append(m_temp)
@@ -784,18 +886,25 @@ class Simulation:
         self.past_err = err
         self.temp_buffer = []
 
-    def run_sim(self, initial_temp, measure_freq, control_freq):
-        global progress_bar_value, progress_bar_text, cancel_sim
-        progress_bar_text = "Simulating..."
-        progress_bar_value = 0
-
-        time = []
-        outside_temperature = []
-        room_temperature = []
-        reference_temperature = []
-        measured_temperature = []
-        heater_state = []
-
+    def get_sim_len(self):
+        step_range = int(3600 / self.step_size)
+        return step_range * (len(self.ambient_temp) - 1) + 1
+
+    # A progress.ProgressToken passed as progress is updated every PROGRESS_STEPS steps, a cancelled
+    # run stops there and returns the steps simulated so far
+    def run_sim(self, initial_temp, measure_freq, control_freq, progress=None):
+        result = SimulationResult(self.get_sim_len())
+        result.truncate(0)
+        chunk_steps = None if progress is None else PROGRESS_STEPS
+        for chunk in self.iter_run(initial_temp, measure_freq, control_freq, chunk_steps, progress=progress):
+            result.extend(chunk)
+        return result
+
+    # Yields the traces in SimulationResult chunks of chunk_steps steps while the simulation runs,
+    # with chunk_steps=None the whole run is a single chunk. A profiling.PhaseStats passed as stats
+    # collects where the time goes. A progress.ProgressToken passed as progress is updated after
+    # every chunk and a cancelled run ends there.
+    def iter_run(self, initial_temp, measure_freq, control_freq, chunk_steps=10000, stats=None, progress=None):
         temp = initial_temp
         self.m_temp = initial_temp
 
@@ -805,45 +914,106 @@ class Simulation:
         self.past_err = 0
 
         step_range = int(3600 / self.step_size)
-        sim_len = step_range * (len(self.ambient_temp) - 1) + 1
-        ref_freq = int(np.ceil(sim_len / len(self.ref)))
-        r_idx = 0
-        ref = self.ref[r_idx]
+        sim_len = self.get_sim_len()
+        ref = self.get_reference_trace(0)
+        if chunk_steps is None:
+            chunk_steps = sim_len
+
+        for chunk_start in range(0, sim_len, chunk_steps):
+            start = time.perf_counter()
+            result = SimulationResult(min(chunk_steps, sim_len - chunk_start))
+            steps = np.arange(chunk_start, chunk_start + len(result))
+            result.time[:] = steps / step_range
+            result.outside_temperature[:] = self.get_ambient_trace(steps)
+            ambient_end = time.perf_counter()
+            result.reference_temperature[:] = self.get_reference_trace(steps)
+            if stats is None:
+                temp, ref = self._steps(result, chunk_start, temp, ref, measure_freq, control_freq)
+            else:
+                stats.add("ambient", ambient_end - start)
+                stats.add("reference", time.perf_counter() - ambient_end)
+                temp, ref = self._timed_steps(result, chunk_start, temp, ref, measure_freq, control_freq, stats)
+                stats.wall_time += time.perf_counter() - start
+            yield result
+            if progress is not None and progress.update(chunk_start + len(result), sim_len):
+                break
 
-        for s in range(sim_len):
-            t = s / step_range
+    # Steps through the chunk result from temp, returns the state to carry on with
+    def _steps(self, result, chunk_start, temp, ref, measure_freq, control_freq):
+        room_temperature = result.room_temperature
+        outside_temperature = result.outside_temperature
+        reference_temperature = result.reference_temperature
+        measured_temperature = result.measured_temperature
+        heater_state = result.heater_state
 
-            background_temp = self.get_background_temp(t)
-            temp = self.update_temp(temp, background_temp)
+        for i in range(len(result)):
+            s = chunk_start + i
+            temp = self.update_temp(temp, outside_temperature[i])
 
             if s % measure_freq == 0:
                 self.measure_temp(temp)
             if s % control_freq == 0:
                 self.control(ref)
-            if s % ref_freq == 0 and s != 0:
-                r_idx += 1
-                ref = self.ref[r_idx]
-
-            time.append(t)
-            room_temperature.append(temp)
-            outside_temperature.append(background_temp)
-            reference_temperature.append(ref)
-            measured_temperature.append(self.m_temp)
-            heater_state.append(self.heater)
-            progress_bar_value = int(100 * (s + 1) / sim_len)
-            if s % sim_len / 4 == 0:
-                print("")
-            if cancel_sim:
-                break
-        progress_bar_value = 0
-        progress_bar_text = ""
-        return time, room_temperature, outside_temperature, reference_temperature, \
-               measured_temperature, heater_state
+            # The reference of a step is used from the next control tick on
+            ref = reference_temperature[i]
+
+            room_temperature[i] = temp
+            measured_temperature[i] = self.m_temp
+            heater_state[i] = self.heater
+        return temp, ref
+
+    # _steps with the time of every measurement and control tick added to stats, and the times of
+    # every sample_every-th model update and recording of a step as samples
+    def _timed_steps(self, result, chunk_start, temp, ref, measure_freq, control_freq, stats):
+        clock = time.perf_counter
+        sample_every = stats.sample_every
+        measure_time = control_time = 0.0
+        measure_calls = control_calls = 0
+        update_samples = []
+        record_samples = []
+        room_temperature = result.room_temperature
+        outside_temperature = result.outside_temperature
+        reference_temperature = result.reference_temperature
+        measured_temperature = result.measured_temperature
+        heater_state = result.heater_state
+
+        for i in range(len(result)):
+            s = chunk_start + i
+            timed = s % sample_every == 0
+            if timed:
+                start = clock()
+            temp = self.update_temp(temp, outside_temperature[i])
+            if timed:
+                update_samples.append(clock() - start)
 
-    def calibrate(self, control_freq):
-        global progress_bar_value, progress_bar_text, cancel_calibrate
-        progress_bar_text = "Calibrating..."
-        progress_bar_value = 0
+            if s % measure_freq == 0:
+                start = clock()
+                self.measure_temp(temp)
+                measure_time += clock() - start
+                measure_calls += 1
+            if s % control_freq == 0:
+                start = clock()
+                self.control(ref)
+                control_time += clock() - start
+                control_calls += 1
+            ref = reference_temperature[i]
+
+            if timed:
+                start = clock()
+            room_temperature[i] = temp
+            measured_temperature[i] = self.m_temp
+            heater_state[i] = self.heater
+            if timed:
+                record_samples.append(clock() - start)
+        stats.add_samples("update_temp", update_samples, len(result))
+        stats.add("measure_temp", measure_time, measure_calls)
+        stats.add("control", control_time, control_calls)
+        stats.add_samples("record", record_samples, len(result))
+        return temp, ref
+
+    # A progress.ProgressToken passed as progress is updated after every round, a cancelled
+    # calibration returns the best gains found so far
+    def calibrate(self, control_freq, progress=None):
 
         pid = np.array([1.0, 0.0, 0.0])
         best_pid = pid
@@ -944,11 +1114,8 @@ class Simulation:
 
             pid = new_pid #np.clip(new_pid, pid - 1, pid + 1)
             print(pid)
-            progress_bar_value = i + 1
-            if cancel_calibrate:
+            if progress is not None and progress.update(i + 1, 100):
                 break
-        progress_bar_value = 0
-        progress_bar_text = ""
         return best_pid
 
 
@@ -956,6 +1123,9 @@ class Simulation:
 if __name__ == '__main__':
     root = Root()
     root.after(0, root.update_ui)
-    root.mainloop()
+    try:
+        root.mainloop()
+    finally:
+        root.shutdown()
     root.quit()
 
@@ -0,0 +1,166 @@
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+from weather import date_to_hour
+
+
+ARCHIVE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "climate.archive")
+MAGIC = b"TCSIMARC"
+VERSION = 1
+DATA_ALIGN = 4096
+
+# Column names used by Environment Canada hourly data and by the csv shipped with the simulator
+DATE_COLUMNS = ["Date/Time (LST)", "Date/Time", "Date"]
+TEMP_COLUMNS = ["Temp (°C)", "Temp (Â°C)", "Temperature"]
+
+
+# An archive is a single file holding hourly temperature series of many stations. It starts with
+# MAGIC, the length of a json header and the header, which lists the dtype and for every station its
+# start hour, offset and length in the data. The data follows at the next DATA_ALIGN boundary as one
+# flat array, so every series is read through a single memory map and slices of it are views.
+class ClimateArchive:
+    def __init__(self, path=ARCHIVE_PATH):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(path + " is not a climate archive")
+            header_len = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+            header = json.loads(f.read(header_len).decode('utf-8'))
+        if header["version"] != VERSION:
+            raise ValueError("Unsupported climate archive version " + str(header["version"]))
+        self.dtype = np.dtype(header["dtype"])
+        self.index = {entry["station"]: entry for entry in header["stations"]}
+        data_len = sum(entry["length"] for entry in header["stations"])
+        if data_len:
+            self.data = np.asarray(np.memmap(path, dtype=self.dtype, mode='r',
+                                             offset=_data_offset(header_len), shape=(data_len,)))
+        else:
+            self.data = np.zeros(0, dtype=self.dtype)
+
+    @property
+    def stations(self):
+        return list(self.index)
+
+    def _entry(self, station):
+        if station not in self.index:
+            raise KeyError("Station " + str(station) + " is not in " + self.path)
+        return self.index[station]
+
+    # First and last hour of a station as datetime64[h]
+    def get_span(self, station):
+        entry = self._entry(station)
+        start = np.datetime64(entry["start"], 'h')
+        return start, start + np.timedelta64(entry["length"] - 1, 'h')
+
+    def get_years(self, station):
+        start, end = self.get_span(station)
+        return list(range(start.astype(object).year, end.astype(object).year + 1))
+
+    def get_series(self, station):
+        entry = self._entry(station)
+        return self.data[entry["offset"]:entry["offset"] + entry["length"]]
+
+    # Hourly temperatures from start_date to end_date inclusive, oldest first. The result is a view of
+    # the memory map, nothing is read until it is used.
+    def get_temperatures(self, station, start_date, end_date):
+        start, end = self.get_span(station)
+        start_hour = date_to_hour(start_date)
+        end_hour = date_to_hour(end_date)
+        if start_hour < start or end_hour > end or end_hour < start_hour:
+            raise ValueError("No data for " + str(station) + " from " + str(start_hour) + " to "
+                             + str(end_hour) + ", the data covers " + str(start) + " to " + str(end))
+        first = int((start_hour - start) // np.timedelta64(1, 'h'))
+        last = int((end_hour - start) // np.timedelta64(1, 'h'))
+        return self.get_series(station)[first:last + 1]
+
+
+def _data_offset(header_len):
+    offset = len(MAGIC) + 8 + header_len
+    return -(-offset // DATA_ALIGN) * DATA_ALIGN
+
+
+# series maps a station id to (start hour, hourly temperatures). The file is written under a
+# temporary name and moved into place so open memory maps of the old archive stay valid.
+def write_archive(series, path=ARCHIVE_PATH, dtype="float64"):
+    stations = []
+    offset = 0
+    for station, (start, values) in series.items():
+        stations.append({"station": station,
+                         "start": str(np.datetime64(start, 'h')),
+                         "offset": offset,
+                         "length": len(values)})
+        offset += len(values)
+    header = json.dumps({"version": VERSION, "dtype": np.dtype(dtype).str, "stations": stations}).encode('utf-8')
+
+    tmp_path = path + "." + str(os.getpid()) + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.array([len(header)], dtype='<u8').tobytes())
+        f.write(header)
+        f.write(b"\0" * (_data_offset(len(header)) - f.tell()))
+        for start, values in series.values():
+            f.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+    os.replace(tmp_path, path)
+
+
+# Reads Environment Canada style hourly csvs into one hourly series, oldest first. The timestamps are
+# local, so an hour repeated when the clocks fall back is averaged and hours without a value (the
+# hour skipped when they spring forward or missing readings) are interpolated.
+def read_station_csvs(csv_paths):
+    frames = []
+    for csv_path in csv_paths:
+        table = pd.read_csv(csv_path)
+        date_column = next((c for c in DATE_COLUMNS if c in table.columns), None)
+        temp_column = next((c for c in TEMP_COLUMNS if c in table.columns), None)
+        if date_column is None or temp_column is None:
+            raise ValueError(csv_path + " has no date or temperature column")
+        frames.append(pd.DataFrame({"hour": pd.to_datetime(table[date_column].str[:19]).dt.floor('h'),
+                                    "temperature": table[temp_column].astype(float)}))
+    data = pd.concat(frames).groupby("hour")["temperature"].mean()
+    hours = pd.date_range(data.index[0], data.index[-1], freq='h')
+    values = data.reindex(hours).interpolate(limit_direction='both').to_numpy()
+    return hours[0].to_datetime64(), values
+
+
+# Adds or replaces the series of a station in the archive, keeping every other station
+def ingest(station, csv_paths, path=ARCHIVE_PATH, dtype=None):
+    series = {}
+    if os.path.exists(path):
+        archive = ClimateArchive(path)
+        if dtype is None:
+            dtype = archive.dtype
+        for name in archive.stations:
+            series[name] = (archive.get_span(name)[0], archive.get_series(name))
+    series[station] = read_station_csvs(csv_paths)
+    write_archive(series, path, "float64" if dtype is None else dtype)
+
+
+_ARCHIVES = {}
+
+
+def get_archive(path=ARCHIVE_PATH):
+    if path not in _ARCHIVES:
+        _ARCHIVES[path] = ClimateArchive(path)
+    return _ARCHIVES[path]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build and inspect climate archives")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    ingest_parser = subparsers.add_parser("ingest", help="add the hourly csvs of a station to an archive")
+    ingest_parser.add_argument("station")
+    ingest_parser.add_argument("csv", nargs="+")
+    ingest_parser.add_argument("--archive", default=ARCHIVE_PATH)
+    ingest_parser.add_argument("--dtype", choices=["float32", "float64"])
+    list_parser = subparsers.add_parser("list", help="list the stations of an archive")
+    list_parser.add_argument("--archive", default=ARCHIVE_PATH)
+    args = parser.parse_args()
+
+    if args.command == "ingest":
+        ingest(args.station, args.csv, args.archive, args.dtype)
+    archive = ClimateArchive(args.archive)
+    for name in archive.stations:
+        start, end = archive.get_span(name)
+        print(name, start, end, len(archive.get_series(name)), "hours")
@@ -0,0 +1,251 @@
+import itertools
+import numpy as np
+from Simulator import get_step_gain
+from weather import date_to_hour, get_date_index, get_temperatures
+from archive import ARCHIVE_PATH, get_archive
+from fusion import weighted_mean
+from noise import get_seed_sequence
+from schedule import Schedule
+
+
+STATUS_CODES = {"None": 0,
+                "Short": 1,
+                "Faulty Connection": 2,
+                "Overheated": 3}
+
+
+def _as_rows(value, n, dtype=float):
+    rows = np.asarray(value, dtype=dtype)
+    if rows.ndim == 0:
+        return np.full(n, rows, dtype=dtype)
+    if rows.shape != (n,):
+        raise ValueError("expected a scalar or a sequence of length " + str(n) + ", got shape " + str(rows.shape))
+    return rows.copy()
+
+
+def _num_rows(*values):
+    n = 1
+    for value in values:
+        if isinstance(value, (list, tuple, np.ndarray)):
+            if n != 1 and len(value) != n:
+                raise ValueError("parameter sequences have different lengths")
+            n = len(value)
+    return n
+
+
+# A ref given per row is a sequence of reference lists or schedules
+def _ref_per_row(ref):
+    return isinstance(ref, (list, tuple)) and isinstance(ref[0], (list, tuple, np.ndarray, Schedule))
+
+
+# Reference lists are padded with their last value so that every row can be indexed as one table.
+# Rows following a schedule are returned grouped by schedule, their table rows are unused.
+def _ref_table(ref, n):
+    if ref is None:
+        ref = [20]
+    if not _ref_per_row(ref):
+        ref = [ref] * n
+    elif len(ref) != n:
+        raise ValueError("expected " + str(n) + " reference lists, got " + str(len(ref)))
+    schedules = {}
+    for i, r in enumerate(ref):
+        if isinstance(r, Schedule):
+            schedules.setdefault(id(r), (r, []))[1].append(i)
+    ref = [[0] if isinstance(r, Schedule) else r for r in ref]
+    lengths = np.array([len(r) for r in ref])
+    table = np.empty((n, lengths.max()))
+    for i, r in enumerate(ref):
+        table[i, :len(r)] = r
+        table[i, len(r):] = r[-1]
+    return table, lengths, list(schedules.values())
+
+
+class BatchSimulation:
+    # Runs N configurations of Simulation in lockstep, advancing every room with one set of numpy
+    # operations per step. Any parameter may be a scalar (shared by all rows) or a sequence of
+    # length N; step_size is shared since all rooms advance on the same clock. size gives the number
+    # of rows when every parameter is a scalar, e.g. for an ensemble of one configuration.
+    def __init__(self, start_date=None, end_date=None, num_sensors=5, K=25, tau=15, step_size=15,
+                 use_weighted_mean=False, P=1, I=0, D=0, ref=None, status="None", clamp=None,
+                 integrator="euler", station=None, archive=ARCHIVE_PATH, seed=None,
+                 size=None):
+        if np.ndim(step_size) != 0:
+            raise ValueError("step_size must be shared by all rows of a batch")
+        # A clamp of None disables the clamp band, as in Simulation
+        if isinstance(clamp, (list, tuple, np.ndarray)):
+            clamp = [np.inf if c is None else c for c in clamp]
+        elif clamp is None:
+            clamp = np.inf
+        if _ref_per_row(ref):
+            n = _num_rows(num_sensors, K, tau, use_weighted_mean, P, I, D, status, clamp, ref)
+        else:
+            n = _num_rows(num_sensors, K, tau, use_weighted_mean, P, I, D, status, clamp)
+        if size is not None:
+            if n != 1 and n != size:
+                raise ValueError("parameter sequences of length " + str(n) + " in a batch of size " + str(size))
+            n = size
+        self.n = n
+
+        # Simulation Parameters
+        self.K = _as_rows(K, n)
+        self.tau = _as_rows(tau, n)
+        self.step_size = step_size
+        self.heater = np.zeros(n)
+        self.integrator = integrator
+        self.step_gain = get_step_gain(integrator, step_size, self.tau)
+
+        # Control Parameters
+        self.P = _as_rows(P, n)
+        self.I = _as_rows(I, n)
+        self.D = _as_rows(D, n)
+        self.clamp = _as_rows(clamp, n)
+        self.ref_table, self.ref_lengths, self.schedules = _ref_table(ref, n)
+
+        # Ambient Temperature
+        if start_date is None:
+            start_date = [2019, 'October', 6, 0]
+        if end_date is None:
+            end_date = [2020, 'October', 5, 23]
+        self.start_hour = date_to_hour(start_date)
+        if station is not None:
+            self.ambient_temp = get_archive(archive).get_temperatures(station, start_date, end_date)
+        else:
+            start_index = get_date_index(start_date)
+            end_index = get_date_index(end_date)
+            self.ambient_temp = np.flip(get_temperatures()[end_index : start_index + 1])
+
+        # Sensor Array Setup
+        self.num_sensors = _as_rows(num_sensors, n, int)
+        self.use_weighted_mean = _as_rows(use_weighted_mean, n, bool) & (self.num_sensors > 1)
+        if np.ndim(status) == 0:
+            status = [status] * n
+        self.status = np.array([STATUS_CODES[s] for s in status])
+        self.sensor_mask = np.arange(self.num_sensors.max()) < self.num_sensors[:, None]
+        self.seed = get_seed_sequence(seed)
+        self.rng = np.random.default_rng(self.seed)
+
+    # Builds a batch over the cartesian product of the given parameter values, e.g.
+    # BatchSimulation.from_grid(K=[20, 25, 30], P=[0.5, 1, 2]) gives 9 rows. The returned list of
+    # dicts describes the parameters of every row in order.
+    @classmethod
+    def from_grid(cls, start_date=None, end_date=None, step_size=15, **grid):
+        names = list(grid)
+        rows = [dict(zip(names, values)) for values in itertools.product(*grid.values())]
+        columns = {name: [row[name] for row in rows] for name in names}
+        return cls(start_date=start_date, end_date=end_date, step_size=step_size, **columns), rows
+
+    def get_background_temp(self, t):
+        floor_idx = np.floor(t).astype(int)
+        ceil_idx = np.ceil(t).astype(int)
+        fraction = (t - floor_idx) * (self.ambient_temp[ceil_idx] - self.ambient_temp[floor_idx])
+        return self.ambient_temp[floor_idx] + fraction
+
+    def get_sim_len(self):
+        step_range = int(3600 / self.step_size)
+        return step_range * (len(self.ambient_temp) - 1) + 1
+
+    # Reference temperature of every row at the given step indices, as a (steps, N) array
+    def get_reference_trace(self, steps):
+        steps = np.asarray(steps)
+        sim_len = self.get_sim_len()
+        ref_freq = np.ceil(sim_len / self.ref_lengths).astype(int)
+        trace = self.ref_table[np.arange(self.n), steps[:, None] // ref_freq]
+        for schedule, rows in self.schedules:
+            trace[:, rows] = schedule.compile(self.start_hour, self.step_size, sim_len)[steps][:, None]
+        return trace
+
+    def update_temp(self, temp, background_temp):
+        if self.integrator == "euler":
+            d_temp = self.step_size * (-temp + self.K * self.heater + background_temp) / self.tau
+        else:
+            d_temp = self.step_gain * (-temp + self.K * self.heater + background_temp)
+        return temp + d_temp
+
+    def measure_temp(self, temp, rows):
+        # The TMP116 sensors have an accuracy of +-0.2°C
+        mask = self.sensor_mask[rows]
+        measurements = self.rng.normal(temp[rows, None], 0.2, mask.shape)
+        status = self.status[rows]
+        measurements[status == 1, 0] = 0
+        faulty = (status == 2) & (self.rng.random(len(rows)) < 0.5)
+        measurements[faulty, 0] += 5 * self.rng.random(np.count_nonzero(faulty))
+        overheated = status == 3
+        measurements[overheated, 0] += self.rng.normal(5, 1, np.count_nonzero(overheated))
+
+        m_temp = np.sum(measurements * mask, axis=1) / self.num_sensors[rows]
+        weighted = self.use_weighted_mean[rows]
+        if weighted.any():
+            m_temp[weighted] = weighted_mean(measurements[weighted], self.num_sensors[rows][weighted])
+        self.buffer_sum[rows] += m_temp
+        self.buffer_count[rows] += 1
+
+    def control(self, ref, rows):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.m_temp[rows] = self.buffer_sum[rows] / self.buffer_count[rows]
+        control_freq = self.control_freq[rows]
+        err = ref[rows] - self.m_temp[rows]
+        self.int_err[rows] += err * control_freq
+        der_err = (err - self.past_err[rows]) / control_freq
+        g = self.P[rows] * err + self.I[rows] * self.int_err[rows] + self.D[rows] * der_err
+        u = np.clip(g, 0, 1)
+
+        clamp = self.clamp[rows]
+        self.heater[rows] = np.where(err > clamp, 1, np.where(err < -clamp, 0, u > 0.5))
+
+        self.past_err[rows] = err
+        self.buffer_sum[rows] = 0
+        self.buffer_count[rows] = 0
+
+    def run_sim(self, initial_temp, measure_freq, control_freq):
+        return next(self.iter_run(initial_temp, measure_freq, control_freq, chunk_steps=None))
+
+    # Runs the batch like run_sim but yields the traces in chunks of chunk_steps steps, as tuples
+    # ordered like the return value of run_sim. With chunk_steps=None the whole run is one chunk.
+    def iter_run(self, initial_temp, measure_freq, control_freq, chunk_steps=10000):
+        n = self.n
+        temp = _as_rows(initial_temp, n)
+        self.m_temp = temp.copy()
+        measure_freq = _as_rows(measure_freq, n, int)
+        self.control_freq = _as_rows(control_freq, n, int)
+        self.buffer_sum = np.zeros(n)
+        self.buffer_count = np.zeros(n)
+        self.int_err = np.zeros(n)
+        self.past_err = np.zeros(n)
+        self.heater = np.zeros(n)
+
+        step_range = int(3600 / self.step_size)
+        sim_len = self.get_sim_len()
+        ref = self.get_reference_trace([0])[0]
+        if chunk_steps is None:
+            chunk_steps = sim_len
+
+        for chunk_start in range(0, sim_len, chunk_steps):
+            chunk_len = min(chunk_steps, sim_len - chunk_start)
+            steps = np.arange(chunk_start, chunk_start + chunk_len)
+            time = steps / step_range
+            outside_temperature = self.get_background_temp(time)
+
+            # Traces are filled step-major so each step writes one contiguous row; the returned
+            # (N, steps) arrays are transposed views of them
+            room_temperature = np.empty((chunk_len, n))
+            reference_temperature = self.get_reference_trace(steps)
+            measured_temperature = np.empty((chunk_len, n))
+            heater_state = np.empty((chunk_len, n), dtype=np.int8)
+
+            for i in range(chunk_len):
+                s = chunk_start + i
+                temp = self.update_temp(temp, outside_temperature[i])
+
+                rows = np.flatnonzero(s % measure_freq == 0)
+                if len(rows):
+                    self.measure_temp(temp, rows)
+                rows = np.flatnonzero(s % self.control_freq == 0)
+                if len(rows):
+                    self.control(ref, rows)
+                ref = reference_temperature[i]
+
+                room_temperature[i] = temp
+                measured_temperature[i] = self.m_temp
+                heater_state[i] = self.heater
+            yield time, room_temperature.T, outside_temperature, reference_temperature.T, \
+                  measured_temperature.T, heater_state.T
@@ -0,0 +1,281 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import timeit
+import tracemalloc
+import numpy as np
+import matplotlib
+# The GUI's plotting is benchmarked off screen, the backend has to be chosen before main is imported
+matplotlib.use('Agg')
+from matplotlib import pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import main
+from Simulator import Simulation
+from fusion import loop_weighted_mean, weighted_mean
+from metrics import summarize
+from weather import get_date_index
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+START_DATE = [2019, 'November', 1, 0]
+PERIODS = {"day": [2019, 'November', 2, 0],
+           "month": [2019, 'December', 1, 0],
+           "year": [2020, 'October', 5, 23]}
+SENSOR_COUNTS = (5, 50, 500)
+SEED = 0
+
+# A peak may grow by this much on top of the threshold before it counts as a regression
+MEMORY_SLACK_MB = 1
+
+
+# Best time of one call of fn [s]. fn is called often enough to take at least 0.2 s, and that is
+# repeated while the calls are short.
+def measure(fn, repeat=5):
+    timer = timeit.Timer(fn)
+    number, total = timer.autorange()
+    times = [total / number]
+    if total < 1:
+        times += [t / number for t in timer.repeat(repeat - 1, number)]
+    return min(times)
+
+
+# Largest memory allocated through Python and numpy during one call of fn [MB]
+def peak_memory(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+
+class _Value:
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class HeadlessRoot:
+    # The parts of main.Root that plot_data and save_data use, drawn to an Agg canvas in place of
+    # the Tk window
+    get_plot_lines = main.Root.get_plot_lines
+    plot_data = main.Root.plot_data
+    plot_ensemble = main.Root.plot_ensemble
+    save_data = main.Root.save_data
+
+    def __init__(self, result, path):
+        self.result = result
+        self.csv_path = _Value(path)
+        self.plot_outside = _Value(True)
+        self.plot_ref = _Value(True)
+        self.plot_measure = _Value(True)
+        self.plot_room = _Value(True)
+        self.live_plot = None
+        self.ensemble = None
+        self.fig = plt.figure(figsize=(8, 6), dpi=100)
+        self.canvas = FigureCanvasAgg(self.fig)
+
+
+def _sim(period="day", **kwargs):
+    return Simulation(start_date=START_DATE, end_date=PERIODS[period], seed=SEED, **kwargs)
+
+
+def _call(method, *args):
+    return lambda: method(*args)
+
+
+def _control(sim):
+    sim.control_freq = 60
+    sim.int_err = 0
+    sim.past_err = 0
+
+    def fn():
+        sim.temp_buffer = [20.1, 20.2, 19.9, 20.0]
+        sim.control(20)
+    return fn
+
+
+def _measure_temp(sim):
+    def fn():
+        sim.temp_buffer = []
+        sim.measure_temp(20.0)
+    return fn
+
+
+# Benchmarks by name as (setup, steps). setup returns the function to time, steps is how many
+# simulation steps one call covers, or 1 for the single calls of the micro benchmarks. The save and
+# plot benchmarks write their files into directory.
+def get_benchmarks(directory, periods=tuple(PERIODS)):
+    benchmarks = {
+        "Simulation.__init__": (lambda: _sim, 1),
+        "get_date_index": (lambda: _call(get_date_index, START_DATE), 1),
+        "get_background_temp": (lambda: _call(_sim().get_background_temp, 10.25), 1),
+        "update_temp": (lambda: _call(_sim().update_temp, 20.0, -5.0), 1),
+        "control": (lambda: _control(_sim()), 1),
+        "calibrate": (lambda: _call(_sim().calibrate, 60), 1),
+        "calibrate (GUI)": (lambda: _call(main.Simulation().calibrate, 60), 1),
+    }
+    for n in SENSOR_COUNTS:
+        for fusion in ("mean", "weighted_mean"):
+            benchmarks["measure_temp " + fusion + " x" + str(n)] = \
+                (lambda n=n, fusion=fusion: _measure_temp(_sim(num_sensors=n, fusion=fusion)), 1)
+    for period in periods:
+        benchmarks["run_sim " + period] = \
+            (lambda period=period: _call(_sim(period).run_sim, 20, 15, 60), _sim(period).get_sim_len())
+    steps = _sim("month").get_sim_len()
+    for extension in (".csv", ".npz"):
+        benchmarks["save_data " + extension + " month"] = \
+            (lambda extension=extension: _save_data(directory, extension), steps)
+    benchmarks["plot_data month"] = (lambda: _plot_data(directory), steps)
+    return benchmarks
+
+
+def _month_root(directory, extension=".csv"):
+    result = _sim("month").run_sim(20, 15, 60)
+    return HeadlessRoot(result, os.path.join(directory, "Temperature_Data" + extension))
+
+
+def _save_data(directory, extension):
+    return _month_root(directory, extension).save_data
+
+
+def _plot_data(directory):
+    root = _month_root(directory)
+    plt.figure(root.fig.number)
+    main.update_plot = True
+    return lambda: root.plot_data(root.result)
+
+
+# The per step loop run_sim was built from, calling get_background_temp, update_temp, measure_temp
+# and control one step at a time. Returns the room, measured and heater traces.
+def scalar_run(sim, initial_temp, measure_freq, control_freq):
+    step_range = int(3600 / sim.step_size)
+    sim_len = sim.get_sim_len()
+    references = sim.get_reference_trace(np.arange(sim_len))
+    sim.m_temp = initial_temp
+    sim.control_freq = control_freq
+    sim.temp_buffer = []
+    sim.int_err = 0
+    sim.past_err = 0
+    room = np.zeros(sim_len)
+    measured = np.zeros(sim_len)
+    heater = np.zeros(sim_len, dtype=np.int8)
+
+    temp = initial_temp
+    ref = references[0]
+    for s in range(sim_len):
+        temp = sim.update_temp(temp, sim.get_background_temp(s / step_range))
+        if s % measure_freq == 0:
+            sim.measure_temp(temp)
+        if s % control_freq == 0:
+            sim.control(ref)
+        ref = references[s]
+        room[s] = temp
+        measured[s] = sim.m_temp
+        heater[s] = sim.heater
+    return room, measured, heater
+
+
+# Largest difference of every fast path to its reference with fixed seeds, by name
+def check_equivalence():
+    checks = {}
+    for fusion in ("mean", "weighted_mean"):
+        result = _sim(fusion=fusion, status="Faulty Connection").run_sim(20, 15, 60)
+        room, measured, heater = scalar_run(_sim(fusion=fusion, status="Faulty Connection"), 20, 15, 60)
+        checks["run_sim " + fusion + " vs scalar loop"] = max(np.max(np.abs(result.room_temperature - room)),
+                                                            np.max(np.abs(result.measured_temperature - measured)),
+                                                            np.max(np.abs(result.heater_state - heater)))
+
+    rng = np.random.default_rng(SEED)
+    samples = [rng.normal(20, 0.2, n) for n in SENSOR_COUNTS for _ in range(10)]
+    checks["weighted_mean vs loop"] = max(abs(weighted_mean(s) - loop_weighted_mean(s)) for s in samples)
+
+    sim = _sim()
+    expected = summarize(sim.run_sim(20, 15, 60), sim.step_size)
+    metrics = _sim().run_sim(20, 15, 60, record="summary")
+    checks["summary vs trace metrics"] = max(abs(metrics[name] - expected[name]) for name in expected)
+    return checks
+
+
+# Runs the benchmarks whose name contains only (all by default). Returns per benchmark the time of
+# one call [s], steps/s and, unless memory is False, the peak memory of a call [MB]. The files the
+# benchmarks save go to a temporary directory that is removed afterwards.
+def run_benchmarks(periods=tuple(PERIODS), only=None, memory=True, callback=None):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, (setup, steps) in get_benchmarks(directory, periods).items():
+            if only is not None and only not in name:
+                continue
+            fn = setup()
+            seconds = measure(fn)
+            results[name] = {"seconds": seconds, "steps_per_s": steps / seconds}
+            if memory:
+                results[name]["peak_memory_mb"] = peak_memory(fn)
+            plt.close('all')
+            if callback is not None:
+                callback(name, results[name])
+    return results
+
+
+# Benchmarks that got slower than the baseline by more than threshold (a fraction of the baseline
+# steps/s) or whose peak memory grew by more than threshold, with a message for each
+def find_regressions(results, baseline, threshold=0.2):
+    regressions = {}
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if result["steps_per_s"] < (1 - threshold) * base["steps_per_s"]:
+            regressions[name] = ("steps/s fell from " + format(base["steps_per_s"], ".4g") + " to "
+                                 + format(result["steps_per_s"], ".4g"))
+        elif "peak_memory_mb" in result and "peak_memory_mb" in base and \
+                result["peak_memory_mb"] > (1 + threshold) * base["peak_memory_mb"] + MEMORY_SLACK_MB:
+            regressions[name] = ("peak memory grew from " + format(base["peak_memory_mb"], ".4g") + " MB to "
+                                 + format(result["peak_memory_mb"], ".4g") + " MB")
+    return regressions
+
+
+def _print_result(name, result):
+    line = name.ljust(32) + format(result["steps_per_s"], ".4g").rjust(12) + " steps/s"
+    if "peak_memory_mb" in result:
+        line += format(result["peak_memory_mb"], ".4g").rjust(12) + " MB peak"
+    print(line, flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the simulation hot paths against a JSON baseline")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown as a fraction")
+    parser.add_argument("--quick", action="store_true", help="skip the year long run")
+    parser.add_argument("--only", help="run the benchmarks whose name contains this")
+    parser.add_argument("--no-memory", action="store_true", help="skip the peak memory measurements")
+    args = parser.parse_args()
+
+    failed = False
+    for name, difference in check_equivalence().items():
+        ok = difference <= 1e-9
+        failed = failed or not ok
+        print(name.ljust(40) + format(difference, ".3g").rjust(10) + ("" if ok else "  MISMATCH"))
+
+    periods = ("day", "month") if args.quick else tuple(PERIODS)
+    results = run_benchmarks(periods, args.only, not args.no_memory, _print_result)
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({"python": platform.python_version(), "numpy": np.__version__,
+                       "benchmarks": results}, f, indent=2)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)["benchmarks"]
+        regressions = find_regressions(results, baseline, args.threshold)
+        for name, message in regressions.items():
+            print("REGRESSION " + name + ": " + message)
+        failed = failed or bool(regressions)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,130 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+from noise import spawn_seeds
+from schedule import Schedule
+from sweep import Sweep, make_grid
+from ensemble import PERCENTILES, run_ensemble
+
+
+# Runs simulations without the GUI from a spec file, e.g.
+#     python -m cli runs.toml --workers 8 --out results
+# A spec file is JSON or TOML holding any of
+#     seed       seed of the whole file, the runs and every ensemble get child seeds of it
+#     defaults   run spec keys shared by all runs and ensembles
+#     runs       list of run specs, Simulation keywords plus the run_sim keywords in sweep.RUN_ARGS
+#     grid       list of values per run spec key, run over their cartesian product (sweep.make_grid)
+#     ensembles  list of run specs with the number of members and optionally the percentiles
+# A ref given as text is a schedule read with Schedule.parse. The metrics of the runs and the grid
+# go to runs.csv, every ensemble to ensemble_<i>.npz (percentile bands) and ensemble_<i>.csv
+# (metrics per member), and the timings to timing.json. Nothing here imports Tk or matplotlib.
+
+
+def load_specs(path):
+    if os.path.splitext(path)[1].lower() == ".toml":
+        try:
+            import tomllib
+        except ImportError:
+            raise ImportError("Reading TOML spec files needs Python 3.11 or newer, use a JSON spec file instead")
+        with open(path, 'rb') as f:
+            return tomllib.load(f)
+    with open(path) as f:
+        return json.load(f)
+
+
+def _prepare(spec, defaults):
+    spec = {**defaults, **spec}
+    if isinstance(spec.get("ref"), str):
+        spec["ref"] = Schedule.parse(spec["ref"])
+    return spec
+
+
+# Runs everything in a spec file as loaded by load_specs. Returns the metrics table of the runs (None
+# without runs), a list of (spec, EnsembleResult) and the timing summary. With profile set the
+# timing summary also holds the time of every phase of the runs summed over the runs.
+def run_specs(specs, max_workers=None, profile=False):
+    defaults = specs.get("defaults", {})
+    runs = specs.get("runs", []) + (make_grid(**specs["grid"]) if "grid" in specs else [])
+    ensembles = [_prepare(spec, defaults) for spec in specs.get("ensembles", [])]
+    seeds = spawn_seeds(specs.get("seed"), 1 + len(ensembles))
+
+    start = time.perf_counter()
+    table = None
+    if runs:
+        table = Sweep([_prepare(spec, defaults) for spec in runs], max_workers, seeds[0], profile).run()
+        # Schedules are listed as written in the spec file
+        if "ref" in table:
+            table["ref"] = [str({**defaults, **spec}.get("ref")) for spec in runs]
+    sweep_time = time.perf_counter() - start
+
+    results = []
+    ensemble_times = []
+    for spec, seed in zip(ensembles, seeds[1:]):
+        spec = dict(spec)
+        members = spec.pop("members")
+        percentiles = spec.pop("percentiles", PERCENTILES)
+        ensemble_start = time.perf_counter()
+        results.append((spec, run_ensemble(members, seed=seed, percentiles=percentiles,
+                                           max_workers=max_workers, **spec)))
+        ensemble_times.append(time.perf_counter() - ensemble_start)
+
+    run_times = [] if table is None else table["run_time"].tolist()
+    timing = {"num_runs": len(runs),
+              "num_ensembles": len(ensembles),
+              "max_workers": max_workers or os.cpu_count(),
+              "wall_time": time.perf_counter() - start,
+              "sweep_time": sweep_time,
+              "run_time_total": sum(run_times),
+              "run_time_mean": float(np.mean(run_times)) if run_times else 0.0,
+              "run_time_max": max(run_times, default=0.0),
+              "ensemble_times": ensemble_times}
+    if profile and table is not None:
+        timing["phases"] = {column[len("time "):]: float(table[column].sum())
+                            for column in table if column.startswith("time ")}
+    return table, results, timing
+
+
+def write_results(out, table, results, timing):
+    os.makedirs(out, exist_ok=True)
+    if table is not None:
+        table.to_csv(os.path.join(out, "runs.csv"), index=False)
+    for i, (spec, result) in enumerate(results):
+        np.savez(os.path.join(out, "ensemble_" + str(i) + ".npz"), time=result.time,
+                 outside_temperature=result.outside_temperature,
+                 reference_temperature=result.reference_temperature,
+                 percentiles=result.percentiles, bands=result.bands)
+        result.metrics.to_csv(os.path.join(out, "ensemble_" + str(i) + ".csv"), index=False)
+    with open(os.path.join(out, "timing.json"), 'w') as f:
+        json.dump(timing, f, indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run simulations from a JSON or TOML spec file without the GUI")
+    parser.add_argument("specs", help="spec file (.json or .toml)")
+    parser.add_argument("--workers", type=int, help="worker processes, one per core by default")
+    parser.add_argument("--out", help="directory for the results, the metrics are printed without it")
+    parser.add_argument("--profile", action="store_true", help="print where the time of the runs goes")
+    args = parser.parse_args(argv)
+
+    try:
+        specs = load_specs(args.specs)
+    except ImportError as error:
+        parser.error(str(error))
+    table, results, timing = run_specs(specs, args.workers, args.profile)
+    if args.out is not None:
+        write_results(args.out, table, results, timing)
+    elif table is not None:
+        print(table.to_string())
+    print(str(timing["num_runs"]) + " runs and " + str(timing["num_ensembles"]) + " ensembles in "
+          + format(timing["wall_time"], ".2f") + " s on " + str(timing["max_workers"]) + " workers, "
+          + format(timing["run_time_mean"], ".3f") + " s per run on average")
+    if "phases" in timing:
+        for phase, seconds in timing["phases"].items():
+            print(phase.ljust(16) + format(seconds, ".4f").rjust(12) + " s"
+                  + format(100 * seconds / max(timing["run_time_total"], 1e-12), ".1f").rjust(8) + "%")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import numpy as np
+
+
+# Reduces the samples y(x), with x sorted, to the smallest and largest sample of each of num_buckets
+# equal index ranges, kept in their original order, so spikes survive the decimation. Data that is
+# already small enough is returned as is.
+def minmax_decimate(x, y, num_buckets):
+    n = len(x)
+    if n <= 2 * num_buckets:
+        return x, y
+    # The buckets are a view of y rather than a padded copy, so memory mapped traces are only read
+    bucket_len = -(-n // num_buckets)
+    num_full = n // bucket_len
+    buckets = y[:num_full * bucket_len].reshape(num_full, bucket_len)
+    first = np.arange(num_full) * bucket_len
+    lows = first + np.argmin(buckets, axis=1)
+    highs = first + np.argmax(buckets, axis=1)
+    tail = num_full * bucket_len
+    if tail < n:
+        lows = np.append(lows, tail + np.argmin(y[tail:]))
+        highs = np.append(highs, tail + np.argmax(y[tail:]))
+
+    idx = np.sort(np.stack((lows, highs), axis=1), axis=1).ravel()
+    idx = np.concatenate(([0], idx, [n - 1]))
+    return x[idx], y[idx]
+
+
+# Reduces the band between lower(x) and upper(x) to num_buckets equal index ranges, keeping the
+# smallest lower and largest upper value of each range so the decimated band covers the original
+def envelope_decimate(x, lower, upper, num_buckets):
+    n = len(x)
+    if n <= 2 * num_buckets:
+        return x, lower, upper
+    starts = np.arange(0, n, -(-n // num_buckets))
+    x = np.append(x[starts], x[-1])
+    lower = np.append(np.minimum.reduceat(lower, starts), lower[-1])
+    upper = np.append(np.maximum.reduceat(upper, starts), upper[-1])
+    return x, lower, upper
+
+
+class DecimatedPlot:
+    # Plots lines on ax from decimated data while keeping the full resolution arrays, and decimates
+    # the visible part again whenever the x limits change, e.g. when zooming or panning with the
+    # toolbar. The number of buckets follows the width of the axes in pixels, so the drawing cost
+    # does not depend on the length of the data.
+    def __init__(self, ax):
+        self.ax = ax
+        self.lines = []
+        ax.callbacks.connect('xlim_changed', self.update)
+
+    def num_buckets(self):
+        return max(int(self.ax.bbox.width), 1)
+
+    def plot(self, x, y, *args, **kwargs):
+        x = np.asarray(x)
+        y = np.asarray(y)
+        line, = self.ax.plot(*minmax_decimate(x, y, self.num_buckets()), *args, **kwargs)
+        self.lines.append((line, x, y))
+        return line
+
+    def update(self, ax=None):
+        x_min, x_max = self.ax.get_xlim()
+        num_buckets = self.num_buckets()
+        for line, x, y in self.lines:
+            # One sample past each side keeps the line running to the edges of the axes
+            start = max(np.searchsorted(x, x_min) - 1, 0)
+            stop = np.searchsorted(x, x_max, side='right') + 1
+            line.set_data(*minmax_decimate(x[start:stop], y[start:stop], num_buckets))
@@ -0,0 +1,173 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from Simulator import Simulation
+from batch import BatchSimulation
+from noise import spawn_seeds
+from sweep import RUN_ARGS
+from metrics import RunMetrics, summarize
+
+
+PERCENTILES = (5, 25, 50, 75, 95)
+
+
+class EnsembleResult:
+    # Percentile bands of the room temperature over the members of an ensemble, one row of bands
+    # per percentile, with the outside and reference temperature shared by all members and a table
+    # of the comfort and energy metrics of every member. The members' traces are not kept.
+    def __init__(self, time, outside_temperature, reference_temperature, percentiles, bands, metrics):
+        self.time = time
+        self.outside_temperature = outside_temperature
+        self.reference_temperature = reference_temperature
+        self.percentiles = list(percentiles)
+        self.bands = bands
+        self.metrics = metrics
+
+    def __len__(self):
+        return len(self.time)
+
+    def band(self, percentile):
+        return self.bands[self.percentiles.index(percentile)]
+
+    # Distribution of every metric over the members at the percentiles of the bands
+    def metric_percentiles(self):
+        return self.metrics.quantile(np.array(self.percentiles) / 100)
+
+    # The result reduced to num_buckets equal index ranges for plotting, like
+    # decimate.envelope_decimate: the bands below the middle one keep the smallest and those above
+    # it the largest value of each range, so shading between them covers the original bands. The
+    # other traces keep the first value of each range. Small results are returned as they are.
+    def decimate(self, num_buckets):
+        n = len(self)
+        if n <= 2 * num_buckets:
+            return self
+        starts = np.arange(0, n, -(-n // num_buckets))
+        ends = np.append(starts, n - 1)
+        half = len(self.percentiles) // 2
+        bands = []
+        for i, band in enumerate(self.bands):
+            if i < half:
+                band = np.append(np.minimum.reduceat(band, starts), band[-1])
+            elif i >= len(self.bands) - half:
+                band = np.append(np.maximum.reduceat(band, starts), band[-1])
+            else:
+                band = band[ends]
+            bands.append(band)
+        return EnsembleResult(self.time[ends], self.outside_temperature[ends], self.reference_temperature[ends],
+                              self.percentiles, np.array(bands), self.metrics)
+
+
+# Builds the result from chunks of (time, outside, reference, room, heater) where the last three
+# have one row per member (reference may have a single shared row) and heater may be None when the
+# metrics are given. Only one chunk of the members' traces is in memory at a time.
+def _collect(chunks, step_size, percentiles, metrics=None):
+    times, outsides, references, bands = [], [], [], []
+    sums = None
+    for time, outside, reference, room, heater in chunks:
+        times.append(time)
+        outsides.append(outside)
+        references.append(reference[0])
+        bands.append(np.percentile(room, percentiles, axis=0))
+        if heater is not None:
+            if sums is None:
+                sums = RunMetrics(step_size, len(room))
+            sums.add(reference, room, heater)
+    if metrics is None:
+        metrics = pd.DataFrame(sums.summary())
+    return EnsembleResult(np.concatenate(times), np.concatenate(outsides), np.concatenate(references),
+                          percentiles, np.concatenate(bands, axis=1), metrics)
+
+
+def _batch_chunks(batch, run_args, chunk_steps):
+    for time, room, outside, reference, measured, heater in batch.iter_run(chunk_steps=chunk_steps, **run_args):
+        yield time, outside, reference, room, heater
+
+
+# Advances the iter_run generators of the members together, one chunk each at a time. A member
+# stopping early (a cancelled GUI run) ends the ensemble at its length.
+def _lockstep_chunks(runs):
+    for results in zip(*runs):
+        length = min(len(result) for result in results)
+        yield (results[0].time[:length], results[0].outside_temperature[:length],
+               np.stack([result.reference_temperature[:length] for result in results]),
+               np.stack([result.room_temperature[:length] for result in results]),
+               np.stack([result.heater_state[:length] for result in results]))
+
+
+# Worker of the process pool, runs some members and writes their room temperature to their rows
+# of the memory mapped traces. The worker running member 0 also fills the two shared rows.
+def _run_members(path, shape, members, seeds, sim_args, run_args):
+    traces = np.memmap(path, dtype=np.float64, mode='r+', shape=shape)
+    metrics = {}
+    for m, seed in zip(members, seeds):
+        sim = Simulation(seed=seed, **sim_args)
+        result = sim.run_sim(**run_args)
+        traces[m] = result.room_temperature
+        if m == 0:
+            traces[-2] = result.outside_temperature
+            traces[-1] = result.reference_temperature
+        metrics[m] = summarize(result, sim.step_size)
+    traces.flush()
+    return metrics
+
+
+def _memmap_chunks(traces, time, chunk_steps):
+    for start in range(0, len(time), chunk_steps):
+        stop = start + chunk_steps
+        yield (time[start:stop], traces[-2, start:stop], traces[-1:, start:stop],
+               np.asarray(traces[:-2, start:stop]), None)
+
+
+# Runs num_members realizations of one configuration, given as a run spec like sweep.run_spec
+# (Simulation keywords plus the run_sim keywords in RUN_ARGS), and reduces them to percentile bands
+# of the room temperature and a table of metrics per member. Step mode runs without a fusion method
+# are vectorized across the members as one BatchSimulation seeded with seed. Other runs go to a
+# pool of max_workers processes (one per core by default) with member m seeded by
+# spawn_seeds(seed, num_members)[m], their traces are spooled through a temporary memory mapped
+# file. Either way the same seed gives the same ensemble.
+def run_ensemble(num_members, seed=None, percentiles=PERCENTILES, chunk_steps=10000, max_workers=None, **spec):
+    sim_args = {key: value for key, value in spec.items() if key not in RUN_ARGS}
+    run_args = {key: spec.get(key, default) for key, default in RUN_ARGS.items()}
+
+    if run_args["mode"] == "step" and sim_args.get("fusion") is None:
+        sim_args.pop("fusion", None)
+        del run_args["mode"]
+        batch = BatchSimulation(seed=seed, size=num_members, **sim_args)
+        return _collect(_batch_chunks(batch, run_args, chunk_steps), batch.step_size, percentiles)
+
+    sim = Simulation(**sim_args)
+    sim_len = sim.get_sim_len()
+    time = np.arange(sim_len) / int(3600 / sim.step_size)
+    shape = (num_members + 2, sim_len)
+    seeds = spawn_seeds(seed, num_members)
+    groups = np.array_split(np.arange(num_members), min(max_workers or os.cpu_count(), num_members))
+
+    fd, path = tempfile.mkstemp(suffix=".npy")
+    os.close(fd)
+    try:
+        np.memmap(path, dtype=np.float64, mode='w+', shape=shape).flush()
+        metrics = {}
+        with ProcessPoolExecutor(max_workers=len(groups)) as executor:
+            futures = [executor.submit(_run_members, path, shape, list(group), [seeds[m] for m in group],
+                                       sim_args, run_args) for group in groups]
+            for future in futures:
+                metrics.update(future.result())
+        traces = np.memmap(path, dtype=np.float64, mode='r', shape=shape)
+        metrics = pd.DataFrame([metrics[m] for m in range(num_members)])
+        result = _collect(_memmap_chunks(traces, time, chunk_steps), sim.step_size, percentiles, metrics)
+        del traces
+    finally:
+        os.remove(path)
+    return result
+
+
+# Ensemble of simulations that are already set up, e.g. the GUI's, run in this process by
+# advancing their iter_run generators in lockstep. All members report to and stop on the same
+# progress.ProgressToken.
+def run_lockstep(sims, initial_temp, measure_freq, control_freq, percentiles=PERCENTILES, chunk_steps=10000,
+                 progress=None):
+    runs = [sim.iter_run(initial_temp, measure_freq, control_freq, chunk_steps=chunk_steps, progress=progress)
+            for sim in sims]
+    return _collect(_lockstep_chunks(runs), sims[0].step_size, percentiles)
@@ -0,0 +1,118 @@
+import time
+import numpy as np
+
+
+# Every estimator takes the readings of one room along the last axis, so a single array of readings
+# gives a temperature and an array of rooms x sensors gives one temperature per room.
+
+
+def mean(measurements):
+    return np.mean(measurements, axis=-1)
+
+
+# Sum of the distances from every reading to every other reading, computed from the sorted readings
+# and their cumulative sums in O(n log n). Readings past counts (per room) are padding and ignored.
+def distance_sums(measurements, counts=None):
+    measurements = np.asarray(measurements, dtype=float)
+    n = measurements.shape[-1]
+    if counts is None:
+        counts = n
+    counts = np.asarray(counts)[..., None]
+    valid = np.arange(n) < counts
+
+    order = np.argsort(np.where(valid, measurements, np.inf), axis=-1)
+    x = np.where(valid, np.take_along_axis(measurements, order, axis=-1), 0)
+    below = np.cumsum(x, axis=-1) - x
+    above = np.sum(x, axis=-1, keepdims=True) - below - x
+    k = np.arange(n)
+    sorted_sums = (k * x - below) + (above - (counts - 1 - k) * x)
+
+    sums = np.empty_like(sorted_sums)
+    np.put_along_axis(sums, order, sorted_sums, axis=-1)
+    return np.where(valid, sums, np.inf)
+
+
+# Weights every reading by its inverse squared distance sum to the other readings, so a reading far
+# from the rest counts little. Readings that agree exactly with all others share the whole weight.
+def weighted_mean(measurements, counts=None):
+    measurements = np.asarray(measurements, dtype=float)
+    sums = distance_sums(measurements, counts)
+    with np.errstate(divide='ignore'):
+        weights = sums ** -2.0
+    exact = np.isinf(weights)
+    weights = np.where(np.any(exact, axis=-1, keepdims=True), exact, weights)
+    weights = weights / np.sum(weights, axis=-1, keepdims=True)
+    return np.sum(weights * np.where(np.isfinite(sums) | exact, measurements, 0), axis=-1)
+
+
+def median(measurements):
+    return np.median(measurements, axis=-1)
+
+
+# Mean of the readings left after dropping the given proportion at each end
+def trimmed_mean(measurements, proportion=0.2):
+    x = np.sort(measurements, axis=-1)
+    n = x.shape[-1]
+    cut = min(int(proportion * n), (n - 1) // 2)
+    return np.mean(x[..., cut:n - cut], axis=-1)
+
+
+# Huber M-estimate of the location, found by iteratively reweighted least squares from the median
+# with the scale taken from the median absolute deviation
+def huber(measurements, c=1.345, iterations=10):
+    x = np.asarray(measurements, dtype=float)
+    mu = np.median(x, axis=-1, keepdims=True)
+    scale = 1.4826 * np.median(np.abs(x - mu), axis=-1, keepdims=True)
+    scale = np.where(scale > 0, scale, 1)
+    for _ in range(iterations):
+        r = np.abs(x - mu) / scale
+        w = np.minimum(1, c / np.maximum(r, 1e-12))
+        mu = np.sum(w * x, axis=-1, keepdims=True) / np.sum(w, axis=-1, keepdims=True)
+    return mu[..., 0]
+
+
+FUSION_METHODS = {"mean": mean,
+                  "weighted_mean": weighted_mean,
+                  "median": median,
+                  "trimmed_mean": trimmed_mean,
+                  "huber": huber}
+
+
+# The pairwise weighted mean Simulation.measure_temp used before, kept as the reference for the
+# vectorized version
+def loop_weighted_mean(measurements):
+    weights = []
+    for i in range(len(measurements)):
+        weight = 0
+        for j in range(len(measurements)):
+            if i != j:
+                weight += abs(measurements[i] - measurements[j])
+        weights.append(weight ** -2)
+    weights = np.array(weights) / np.sum(weights)
+    return np.sum(weights * measurements)
+
+
+# Time per call [µs] of every estimator and of the pairwise loop for several numbers of sensors,
+# with the largest difference between the loop and weighted_mean
+def benchmark_fusion(sizes=(5, 50, 500), repeats=20, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for n in sizes:
+        samples = [rng.normal(20, 0.2, n) for _ in range(repeats)]
+        for sample in samples:
+            sample[0] += 5
+        timings = {"loop_weighted_mean": loop_weighted_mean, **FUSION_METHODS}
+        row = {"num_sensors": n}
+        for name, method in timings.items():
+            start = time.perf_counter()
+            for sample in samples:
+                method(sample)
+            row[name + " [µs]"] = 1e6 * (time.perf_counter() - start) / repeats
+        row["max difference [°C]"] = max(abs(loop_weighted_mean(s) - weighted_mean(s)) for s in samples)
+        rows.append(row)
+    return rows
+
+
+if __name__ == '__main__':
+    for row in benchmark_fusion():
+        print(", ".join(name + ": " + format(value, ".4g") for name, value in row.items()))
@@ -0,0 +1,55 @@
+import time
+import numpy as np
+import pandas as pd
+from Simulator import Simulation
+
+
+INTEGRATORS = ["euler", "zoh", "rk4"]
+
+# The heater is held off (P=0) or on (clamp below any error) so the runs are deterministic and the
+# integrators only differ in how they follow the ambient and the heater
+SCENARIOS = {"heater off": {"P": 0},
+             "heater on": {"clamp": -np.inf}}
+
+
+# Accuracy and run time of every integrator at every step size, measured against the exact solution
+# of the model from the event driven run mode. Errors are in °C at the recorded steps.
+def compare_integrators(step_sizes=(15, 60, 300, 900, 1800, 3600), start_date=None, end_date=None,
+                        K=30, tau=900, initial_temp=20):
+    if start_date is None:
+        start_date = [2019, 'October', 6, 0]
+    if end_date is None:
+        end_date = [2019, 'November', 5, 0]
+
+    rows = []
+    for scenario, control in SCENARIOS.items():
+        for step_size in step_sizes:
+            # One control tick an hour is enough as the heater never changes
+            freq = max(int(3600 / step_size), 1)
+            exact = Simulation(start_date=start_date, end_date=end_date, K=K, tau=tau,
+                               step_size=step_size, **control)
+            exact_temp = exact.run_sim(initial_temp, freq, freq, mode="event").room_temperature
+
+            for integrator in INTEGRATORS:
+                sim = Simulation(start_date=start_date, end_date=end_date, K=K, tau=tau,
+                                 step_size=step_size, integrator=integrator, **control)
+                # Euler and RK4 are expected to blow up once step_size is large compared to tau
+                with np.errstate(over='ignore', invalid='ignore'):
+                    start = time.perf_counter()
+                    room_temp = sim.run_sim(initial_temp, freq, freq).room_temperature
+                    seconds = time.perf_counter() - start
+                    err = np.abs(room_temp - exact_temp)
+                    rows.append({"scenario": scenario,
+                                 "integrator": integrator,
+                                 "step size [s]": step_size,
+                                 "steps": len(room_temp),
+                                 "run time [s]": seconds,
+                                 "steps/s": len(room_temp) / seconds,
+                                 "max error [°C]": np.max(err),
+                                 "rms error [°C]": np.sqrt(np.mean(err ** 2))})
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(compare_integrators())
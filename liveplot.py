@@ -0,0 +1,55 @@
+from matplotlib.transforms import Bbox
+from decimate import minmax_decimate
+
+
+class LivePlot:
+    # Draws the traces of a running simulation as they are filled in. The line artists are created
+    # once and animated, every update only draws the samples added since the last one on top of the
+    # existing canvas and blits the changed strip of the axes. A full redraw of the canvas (resize,
+    # toolbar, y limits growing) draws everything filled so far again.
+    # lines is a list of (trace name, fmt, kwargs) as used by Root.plot_data.
+    def __init__(self, canvas, ax, result, lines, x_max, y_lim):
+        self.canvas = canvas
+        self.ax = ax
+        self.result = result
+        self.lines = [(name, ax.plot([], [], fmt, animated=True, **kwargs)[0]) for name, fmt, kwargs in lines]
+        self.drawn = 0
+        ax.set_xlim(0, x_max)
+        ax.set_ylim(*y_lim)
+        self.draw_cid = canvas.mpl_connect('draw_event', self.on_draw)
+
+    def stop(self):
+        self.canvas.mpl_disconnect(self.draw_cid)
+
+    def on_draw(self, event=None):
+        self.drawn = 0
+        self.draw_samples()
+
+    def update(self):
+        if len(self.result) <= self.drawn:
+            return
+        # Growing the y limits needs a full redraw, which calls on_draw
+        y_min, y_max = self.ax.get_ylim()
+        start = max(self.drawn - 1, 0)
+        for name, line in self.lines:
+            y = getattr(self.result, name)[start:]
+            if y.min() < y_min or y.max() > y_max:
+                self.ax.set_ylim(min(y_min, y.min() - 1), max(y_max, y.max() + 1))
+                self.canvas.draw_idle()
+                return
+        self.draw_samples()
+
+    def draw_samples(self):
+        length = len(self.result)
+        if length == 0 or not self.lines:
+            return
+        start = max(self.drawn - 1, 0)
+        time = self.result.time
+        x_start, x_end = self.ax.transData.transform([[time[start], 0], [time[length - 1], 0]])[:, 0]
+        num_buckets = max(int(x_end - x_start), 1)
+        for name, line in self.lines:
+            line.set_data(*minmax_decimate(time[start:length], getattr(self.result, name)[start:length], num_buckets))
+            self.ax.draw_artist(line)
+        bbox = self.ax.bbox
+        self.canvas.blit(Bbox.from_extents(max(x_start - 2, bbox.x0), bbox.y0, min(x_end + 2, bbox.x1), bbox.y1))
+        self.drawn = length
@@ -0,0 +1,66 @@
+import numpy as np
+
+
+class RunMetrics:
+    # Comfort and energy metrics of a run kept as running sums, so a run can be summarized without
+    # keeping its traces. add() takes the next block of steps along the last axis; with a leading
+    # axis of rows (the members of an ensemble, the rows of a batch) every row is tracked on its own.
+    # The error is reference - room, so positive errors are a room colder than its setpoint. Its mean
+    # and variance are merged block by block with the parallel form of Welford's update.
+    def __init__(self, step_size, shape=()):
+        self.step_size = step_size
+        self.count = 0
+        self.error_mean = np.zeros(shape)
+        self.error_m2 = np.zeros(shape)
+        self.squared_error = np.zeros(shape)
+        self.abs_error = np.zeros(shape)
+        self.max_abs_error = np.zeros(shape)
+        self.degree_steps_below = np.zeros(shape)
+        self.heater_on = np.zeros(shape, dtype=np.int64)
+        self.switch_count = np.zeros(shape, dtype=np.int64)
+        self.last_heater = None
+
+    def add(self, reference, room, heater):
+        n = np.shape(room)[-1]
+        if n == 0:
+            return
+        err = reference - room
+        block_mean = np.mean(err, axis=-1)
+        block_m2 = np.sum((err - block_mean[..., None]) ** 2, axis=-1)
+        total = self.count + n
+        delta = block_mean - self.error_mean
+        self.error_mean = self.error_mean + delta * n / total
+        self.error_m2 = self.error_m2 + block_m2 + delta ** 2 * self.count * n / total
+        self.count = total
+
+        abs_err = np.abs(err)
+        self.squared_error = self.squared_error + np.sum(err ** 2, axis=-1)
+        self.abs_error = self.abs_error + np.sum(abs_err, axis=-1)
+        self.max_abs_error = np.maximum(self.max_abs_error, np.max(abs_err, axis=-1))
+        self.degree_steps_below = self.degree_steps_below + np.sum(np.maximum(err, 0), axis=-1)
+
+        self.heater_on = self.heater_on + np.sum(heater, axis=-1)
+        self.switch_count = self.switch_count + np.count_nonzero(np.diff(heater, axis=-1), axis=-1)
+        if self.last_heater is not None:
+            self.switch_count = self.switch_count + (heater[..., 0] != self.last_heater)
+        self.last_heater = heater[..., -1]
+
+    # Metrics so far, by name. Scalars for a single run and arrays with one value per row otherwise.
+    def summary(self):
+        count = max(self.count, 1)
+        step_hours = self.step_size / 3600
+        return {"mean_abs_error": self.abs_error / count,
+                "rms_error": np.sqrt(self.squared_error / count),
+                "max_abs_error": self.max_abs_error,
+                "error_std": np.sqrt(self.error_m2 / count),
+                "degree_hours_below": self.degree_steps_below * step_hours,
+                "heater_on_fraction": self.heater_on / count,
+                "heater_on_hours": self.heater_on * step_hours,
+                "switch_count": self.switch_count}
+
+
+# Metrics of a finished run from its traces
+def summarize(result, step_size):
+    metrics = RunMetrics(step_size)
+    metrics.add(result.reference_temperature, result.room_temperature, result.heater_state)
+    return metrics.summary()
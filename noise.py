@@ -0,0 +1,51 @@
+import numpy as np
+
+
+# Seed sequence for a seed given as None (fresh entropy), an int or an existing SeedSequence
+def get_seed_sequence(seed=None):
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    return np.random.SeedSequence(seed)
+
+
+# n independent child seeds of seed, e.g. one per member of an ensemble or per parallel worker. The
+# same seed always gives the same children, so every member can be replayed on its own.
+def spawn_seeds(seed, n):
+    return get_seed_sequence(seed).spawn(n)
+
+
+class NoiseStream:
+    # Hands out standard normal and uniform samples of a Generator. The samples are drawn in blocks
+    # of block_size and refilled when a block runs out, so the simulation loop does not pay for a
+    # call into the generator at every measurement. The samples only depend on the seed and the
+    # order in which they are taken.
+    def __init__(self, seed=None, block_size=65536):
+        self.seed = get_seed_sequence(seed)
+        self.rng = np.random.default_rng(self.seed)
+        self.block_size = block_size
+        self.normals = np.zeros(0)
+        self.normal_pos = 0
+        self.uniforms = np.zeros(0)
+        self.uniform_pos = 0
+
+    def _refill(self, block, pos, count, draw):
+        rest = block[pos:]
+        return np.concatenate((rest, draw(max(self.block_size, count - len(rest))))), 0
+
+    # Standard normal samples, a single float if count is None
+    def normal(self, count=None):
+        n = 1 if count is None else count
+        if self.normal_pos + n > len(self.normals):
+            self.normals, self.normal_pos = self._refill(self.normals, self.normal_pos, n, self.rng.standard_normal)
+        samples = self.normals[self.normal_pos:self.normal_pos + n]
+        self.normal_pos += n
+        return samples[0] if count is None else samples
+
+    # Uniform samples in [0, 1), a single float if count is None
+    def random(self, count=None):
+        n = 1 if count is None else count
+        if self.uniform_pos + n > len(self.uniforms):
+            self.uniforms, self.uniform_pos = self._refill(self.uniforms, self.uniform_pos, n, self.rng.random)
+        samples = self.uniforms[self.uniform_pos:self.uniform_pos + n]
+        self.uniform_pos += n
+        return samples[0] if count is None else samples
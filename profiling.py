@@ -0,0 +1,72 @@
+import time
+import numpy as np
+
+
+class PhaseStats:
+    # Wall time and call counts per phase of a run or calibration, filled by the run when passed as
+    # stats. Phases called every step are only timed every sample_every steps, their time is the
+    # median of the timed calls times the number of calls, so a single slow call (a garbage
+    # collection, a page fault) is not counted sample_every times over. Phases called rarely are
+    # timed on every call. The time a clock read takes is measured once and taken off every timed
+    # call. Phases are listed in the order they were first seen; wall_time covers the whole run, so
+    # "other" is the loop itself. Should the estimates add up to more than wall_time they are scaled
+    # down to it, the shares of the phases and "other" lie within [0, 1] and add up to 1.
+    def __init__(self, sample_every=64):
+        self.sample_every = sample_every
+        self.wall_time = 0.0
+        self.calls = {}
+        self.timed_seconds = {}
+        self.timed_calls = {}
+        self.samples = {}
+        self.clock_overhead = min(_clock_pair() for _ in range(1000))
+
+    # seconds were spent in calls of the phase, all of them timed
+    def add(self, phase, seconds, calls=1):
+        self.calls[phase] = self.calls.get(phase, 0) + calls
+        self.timed_calls[phase] = self.timed_calls.get(phase, 0) + calls
+        self.timed_seconds[phase] = self.timed_seconds.get(phase, 0.0) + seconds
+
+    # samples are the times of some of the calls of the phase [s], one per timed call
+    def add_samples(self, phase, samples, calls):
+        self.calls[phase] = self.calls.get(phase, 0) + calls
+        self.samples.setdefault(phase, []).append(np.asarray(samples, dtype=float))
+
+    # Estimated total time of the phase [s]
+    def seconds(self, phase):
+        if phase in self.samples:
+            samples = np.concatenate(self.samples[phase])
+            if len(samples) == 0:
+                return 0.0
+            return max(float(np.median(samples)) - self.clock_overhead, 0.0) * self.calls[phase]
+        seconds = self.timed_seconds[phase] - self.timed_calls[phase] * self.clock_overhead
+        return max(seconds, 0.0)
+
+    # Per phase the calls, the estimated time [s], the time per call [µs] and the share of the wall time
+    def summary(self):
+        estimates = {phase: self.seconds(phase) for phase in self.calls}
+        total = sum(estimates.values())
+        scale = self.wall_time / total if total > self.wall_time else 1.0
+        rows = {}
+        for phase, seconds in estimates.items():
+            seconds = seconds * scale
+            rows[phase] = {"calls": self.calls[phase],
+                           "seconds": seconds,
+                           "us_per_call": 1e6 * seconds / max(self.calls[phase], 1),
+                           "share": seconds / self.wall_time if self.wall_time else 0.0}
+        other = max(self.wall_time - sum(row["seconds"] for row in rows.values()), 0.0)
+        rows["other"] = {"calls": 0, "seconds": other, "us_per_call": 0.0,
+                         "share": other / self.wall_time if self.wall_time else 0.0}
+        return rows
+
+    def format(self):
+        lines = ["phase".ljust(16) + "calls".rjust(12) + "time [s]".rjust(12) + "µs/call".rjust(12) + "share".rjust(8)]
+        for phase, row in self.summary().items():
+            lines.append(phase.ljust(16) + str(row["calls"]).rjust(12) + format(row["seconds"], ".4f").rjust(12)
+                         + format(row["us_per_call"], ".3f").rjust(12) + format(100 * row["share"], ".1f").rjust(7) + "%")
+        lines.append("total".ljust(28) + format(self.wall_time, ".4f").rjust(12))
+        return "\n".join(lines)
+
+
+def _clock_pair():
+    start = time.perf_counter()
+    return time.perf_counter() - start
@@ -0,0 +1,63 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+
+# Steps between two progress updates of a run, a few milliseconds of stepping
+PROGRESS_STEPS = 4096
+
+
+class ProgressToken:
+    # Progress and cancellation of one job, shared between the job and whoever watches it. The job
+    # calls update() every so many steps (once per chunk of a run, once per calibration round) and
+    # stops when it returns True, the watcher reads fraction and calls cancel(). Every job gets a
+    # token of its own, so jobs running side by side do not interfere. The state is two floats
+    # written without locks, a single writer per field makes that safe between threads. With
+    # shared=True they live in a shared memory block instead, so the token also works after being
+    # passed to another process (it pickles as the name of the block). The process that created a
+    # shared token frees the block with close() once the job is done.
+    def __init__(self, text="", shared=False):
+        self.text = text
+        self._shm = None
+        self._owner = False
+        if shared:
+            self._shm = shared_memory.SharedMemory(create=True, size=2 * np.dtype(np.float64).itemsize)
+            self._owner = True
+            self._state = np.ndarray(2, dtype=np.float64, buffer=self._shm.buf)
+        else:
+            self._state = np.zeros(2)
+        self._state[:] = 0
+
+    def __getstate__(self):
+        if self._shm is None:
+            raise ValueError("Only a ProgressToken created with shared=True can be passed to another process")
+        return {"text": self.text, "name": self._shm.name}
+
+    def __setstate__(self, state):
+        self.text = state["text"]
+        self._shm = shared_memory.SharedMemory(name=state["name"])
+        self._owner = False
+        self._state = np.ndarray(2, dtype=np.float64, buffer=self._shm.buf)
+
+    @property
+    def fraction(self):
+        return float(self._state[0])
+
+    @property
+    def cancelled(self):
+        return bool(self._state[1])
+
+    # Records that done out of total steps are done, returns whether the job should stop
+    def update(self, done, total):
+        self._state[0] = done / total if total else 1.0
+        return bool(self._state[1])
+
+    def cancel(self):
+        self._state[1] = 1
+
+    def close(self):
+        if self._shm is not None:
+            self._state = np.array(self._state)
+            self._shm.close()
+            if self._owner:
+                self._shm.unlink()
+            self._shm = None
@@ -0,0 +1,460 @@
+import os
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory
+
+
+COLUMNS = {'time': 'Time [h]',
+           'room_temperature': 'Room Temperature [°C]',
+           'reference_temperature': 'Reference Temperature [°C]',
+           'outside_temperature': 'Outside Temperature [°C]',
+           'measured_temperature': 'Measured Temperature [°C]',
+           'heater_state': 'Heater State [On/Off]'}
+
+# File formats of save_result and load_result by extension
+EXPORT_FORMATS = (".csv", ".npz", ".parquet", ".feather")
+
+# Piecewise constant traces an .npz keeps as ChangePoints when they change on at most this share
+# of the steps
+NPZ_MAX_CHANGES = 0.25
+
+
+class SimulationResult:
+    # Traces of a run held in preallocated arrays of sim_len steps which run_sim fills in place.
+    # The properties return views of the filled part, so nothing is copied until to_dataframe.
+    def __init__(self, sim_len):
+        self.length = sim_len
+        self._time = np.zeros(sim_len)
+        self._room_temperature = np.zeros(sim_len)
+        self._outside_temperature = np.zeros(sim_len)
+        self._reference_temperature = np.zeros(sim_len)
+        self._measured_temperature = np.zeros(sim_len)
+        self._heater_state = np.zeros(sim_len, dtype=np.int8)
+
+    # Result holding the given trace arrays by name (the keys of COLUMNS) without copying them
+    @classmethod
+    def from_arrays(cls, traces):
+        result = cls.__new__(cls)
+        for name in COLUMNS:
+            dtype = np.int8 if name == 'heater_state' else np.float64
+            setattr(result, '_' + name, np.asarray(traces[name], dtype=dtype))
+        result.length = len(result._time)
+        return result
+
+    def __len__(self):
+        return self.length
+
+    # Unpacks into the five traces Simulator's run_sim used to return, in that order. The heater
+    # state came later and is only available as an attribute.
+    def __iter__(self):
+        return iter((self.time, self.room_temperature, self.outside_temperature,
+                     self.reference_temperature, self.measured_temperature))
+
+    # Used when a run is cancelled part way, the remaining preallocated steps are dropped
+    def truncate(self, length):
+        self.length = min(length, self.length)
+
+    # Copies the traces of chunk after the filled part. A result for the whole run truncated to 0
+    # collects the chunks of iter_run this way, while readers only ever see the filled part.
+    def extend(self, chunk):
+        start = self.length
+        end = start + len(chunk)
+        self._time[start:end] = chunk.time
+        self._room_temperature[start:end] = chunk.room_temperature
+        self._outside_temperature[start:end] = chunk.outside_temperature
+        self._reference_temperature[start:end] = chunk.reference_temperature
+        self._measured_temperature[start:end] = chunk.measured_temperature
+        self._heater_state[start:end] = chunk.heater_state
+        self.length = end
+
+    @property
+    def time(self):
+        return self._time[:self.length]
+
+    @property
+    def room_temperature(self):
+        return self._room_temperature[:self.length]
+
+    @property
+    def outside_temperature(self):
+        return self._outside_temperature[:self.length]
+
+    @property
+    def reference_temperature(self):
+        return self._reference_temperature[:self.length]
+
+    @property
+    def measured_temperature(self):
+        return self._measured_temperature[:self.length]
+
+    @property
+    def heater_state(self):
+        return self._heater_state[:self.length]
+
+    def to_dataframe(self):
+        return pd.DataFrame({column: getattr(self, name) for name, column in COLUMNS.items()}, copy=False)
+
+
+class MemmapSimulationResult(SimulationResult):
+    # A SimulationResult whose traces are memory mapped .npy files in directory, one per trace named
+    # like the attributes (room_temperature.npy, ...), for runs that do not fit in memory. The chunks
+    # copied in by extend are flushed to disk every FLUSH_STEPS steps, so the pages of a long run can
+    # be dropped by the OS as it goes. The files are plain .npy files that np.load reads back.
+    FLUSH_STEPS = 1 << 20
+
+    def __init__(self, directory, sim_len):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.length = sim_len
+        for name in COLUMNS:
+            dtype = np.int8 if name == 'heater_state' else np.float64
+            setattr(self, '_' + name, np.lib.format.open_memmap(self.path(name), mode='w+', dtype=dtype,
+                                                                  shape=(sim_len,)))
+
+    # Maps the traces a run left in directory. The files hold the whole preallocated run, a run
+    # that was cancelled part way reads back with zeros after the steps it reached.
+    @classmethod
+    def open(cls, directory, mode='r'):
+        result = cls.__new__(cls)
+        result.directory = directory
+        for name in COLUMNS:
+            setattr(result, '_' + name, np.load(result.path(name), mmap_mode=mode))
+        result.length = len(result._time)
+        return result
+
+    def path(self, name):
+        return os.path.join(self.directory, name + ".npy")
+
+    def extend(self, chunk):
+        start = self.length
+        super().extend(chunk)
+        if start // self.FLUSH_STEPS != self.length // self.FLUSH_STEPS:
+            self.flush()
+
+    def flush(self):
+        for name in COLUMNS:
+            getattr(self, '_' + name).flush()
+
+    # Pickles as its directory, the copy in a worker process maps the same files for writing
+    def __getstate__(self):
+        return {"directory": self.directory, "length": self.length}
+
+    def __setstate__(self, state):
+        self.directory = state["directory"]
+        for name in COLUMNS:
+            setattr(self, '_' + name, np.load(self.path(name), mmap_mode='r+'))
+        self.length = state["length"]
+
+
+class SharedSimulationResult(SimulationResult):
+    # A SimulationResult whose traces live in one shared memory block, so a worker process can fill
+    # it while the process that created it plots the traces without copying them. It pickles as the
+    # name of the block and the copy attaches to the same traces. Each copy keeps its own length,
+    # the creator learns how far the worker got from the worker (see worker.SimulationWorker). The
+    # creator frees the block with close() once no copy is used anymore.
+    def __init__(self, sim_len):
+        size = sum(sim_len * np.dtype(_dtype(name)).itemsize for name in COLUMNS)
+        self._shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self._owner = True
+        self._attach(sim_len)
+        self.length = sim_len
+
+    def _attach(self, sim_len):
+        self.sim_len = sim_len
+        offset = 0
+        for name in COLUMNS:
+            dtype = np.dtype(_dtype(name))
+            setattr(self, '_' + name, np.ndarray(sim_len, dtype=dtype, buffer=self._shm.buf, offset=offset))
+            offset += sim_len * dtype.itemsize
+
+    def __getstate__(self):
+        if self._shm is None:
+            raise ValueError("A closed SharedSimulationResult cannot be passed to another process")
+        return {"name": self._shm.name, "sim_len": self.sim_len, "length": self.length}
+
+    def __setstate__(self, state):
+        self._shm = shared_memory.SharedMemory(name=state["name"])
+        self._owner = False
+        self._attach(state["sim_len"])
+        self.length = state["length"]
+
+    # Drops the traces, which read as empty afterwards. The block itself is unmapped once the views
+    # handed out (e.g. to a plot) are gone as well.
+    def close(self):
+        if self._shm is None:
+            return
+        for name in COLUMNS:
+            setattr(self, '_' + name, np.zeros(0, dtype=_dtype(name)))
+        self.length = 0
+        if self._owner:
+            self._shm.unlink()
+        try:
+            self._shm.close()
+        except BufferError:
+            _still_mapped.append(self._shm)
+        self._shm = None
+        # Blocks whose views were still in use at an earlier close
+        for shm in list(_still_mapped):
+            try:
+                shm.close()
+                _still_mapped.remove(shm)
+            except BufferError:
+                pass
+
+
+# Closed shared memory blocks some views still pointed into, unmapped by a later close
+_still_mapped = []
+
+
+def _dtype(name):
+    return np.int8 if name == 'heater_state' else np.float64
+
+
+def _consolidate(parts, dtype):
+    if not parts:
+        return np.zeros(0, dtype=dtype)
+    if len(parts) > 1:
+        parts[:] = [np.concatenate(parts)]
+    return parts[0]
+
+
+class ChangePoints:
+    # A piecewise constant signal stored as the first step of every run and the value of the run.
+    # Samples are appended in chunks, a run continuing across chunks is not split.
+    def __init__(self):
+        self.length = 0
+        self._starts = []
+        self._values = []
+        self._last = None
+
+    def __len__(self):
+        return self.length
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=float)
+        if len(values) == 0:
+            return
+        starts = np.flatnonzero(values[1:] != values[:-1]) + 1
+        if self._last is None or values[0] != self._last:
+            starts = np.insert(starts, 0, 0)
+        self._starts.append(starts + self.length)
+        self._values.append(values[starts])
+        self.length += len(values)
+        self._last = values[-1]
+
+    @property
+    def starts(self):
+        return _consolidate(self._starts, np.int64)
+
+    @property
+    def values(self):
+        return _consolidate(self._values, float)
+
+    def expand(self):
+        return np.repeat(self.values, np.diff(np.append(self.starts, self.length)))
+
+
+class PackedBits:
+    # A 0/1 signal packed eight samples to a byte. Bits that do not fill a byte yet are kept apart
+    # until the next chunk.
+    def __init__(self):
+        self.length = 0
+        self._packed = []
+        self._tail = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return self.length
+
+    def extend(self, bits):
+        bits = np.asarray(bits, dtype=np.uint8)
+        self.length += len(bits)
+        bits = np.concatenate((self._tail, bits))
+        full = len(bits) // 8 * 8
+        self._packed.append(np.packbits(bits[:full]))
+        self._tail = bits[full:]
+
+    def expand(self):
+        packed = np.concatenate((_consolidate(self._packed, np.uint8), np.packbits(self._tail)))
+        return np.unpackbits(packed, count=self.length).astype(np.int8)
+
+
+class CompactSimulationResult:
+    # Traces of a run stored compactly for long runs and for passing results between processes.
+    # The room temperature is kept in float_dtype (float32 by default). The outside temperature is
+    # interpolated from the hourly ambient_temp when given, and kept like the room temperature
+    # otherwise. The reference and measured temperature are change points and the heater state is
+    # bit packed. The properties expand the traces to full arrays on every access, so the result
+    # plots and exports like a SimulationResult. A year at 15 s steps takes about a tenth of the
+    # memory of a SimulationResult.
+    def __init__(self, step_range, ambient_temp=None, float_dtype=np.float32):
+        self.step_range = step_range
+        self.ambient_temp = None if ambient_temp is None else np.array(ambient_temp)
+        self.float_dtype = np.dtype(float_dtype)
+        self.length = 0
+        self._room_temperature = []
+        self._outside_temperature = []
+        self._reference_temperature = ChangePoints()
+        self._measured_temperature = ChangePoints()
+        self._heater_state = PackedBits()
+
+    @classmethod
+    def from_result(cls, result, step_range, ambient_temp=None, float_dtype=np.float32):
+        compact = cls(step_range, ambient_temp, float_dtype)
+        compact.extend(result)
+        return compact
+
+    def __len__(self):
+        return self.length
+
+    # Unpacks like a SimulationResult
+    def __iter__(self):
+        return iter((self.time, self.room_temperature, self.outside_temperature,
+                     self.reference_temperature, self.measured_temperature))
+
+    def extend(self, chunk):
+        self._room_temperature.append(np.asarray(chunk.room_temperature, dtype=self.float_dtype))
+        if self.ambient_temp is None:
+            self._outside_temperature.append(np.asarray(chunk.outside_temperature, dtype=self.float_dtype))
+        self._reference_temperature.extend(chunk.reference_temperature)
+        self._measured_temperature.extend(chunk.measured_temperature)
+        self._heater_state.extend(chunk.heater_state)
+        self.length += len(chunk)
+
+    # Bytes held by the stored traces
+    @property
+    def nbytes(self):
+        arrays = [_consolidate(self._room_temperature, self.float_dtype),
+                  _consolidate(self._outside_temperature, self.float_dtype),
+                  self._reference_temperature.starts, self._reference_temperature.values,
+                  self._measured_temperature.starts, self._measured_temperature.values]
+        if self.ambient_temp is not None:
+            arrays.append(self.ambient_temp)
+        return sum(a.nbytes for a in arrays) + len(self._heater_state) // 8 + 1
+
+    @property
+    def time(self):
+        return np.arange(self.length) / self.step_range
+
+    @property
+    def room_temperature(self):
+        return _consolidate(self._room_temperature, self.float_dtype)
+
+    @property
+    def outside_temperature(self):
+        if self.ambient_temp is None:
+            return _consolidate(self._outside_temperature, self.float_dtype)
+        return np.interp(self.time, np.arange(len(self.ambient_temp)), self.ambient_temp)
+
+    @property
+    def reference_temperature(self):
+        return self._reference_temperature.expand()
+
+    @property
+    def measured_temperature(self):
+        return self._measured_temperature.expand()
+
+    @property
+    def heater_state(self):
+        return self._heater_state.expand()
+
+    def to_dataframe(self):
+        return pd.DataFrame({column: getattr(self, name) for name, column in COLUMNS.items()}, copy=False)
+
+
+# Writes the traces of result as CSV, chunk_steps rows at a time, so the traces are never copied
+# into one DataFrame. Memory mapped traces are only read through.
+def write_csv(result, path, chunk_steps=100000):
+    traces = {column: getattr(result, name) for name, column in COLUMNS.items()}
+    with open(path, 'w', newline='') as f:
+        for start in range(0, max(len(result), 1), chunk_steps):
+            chunk = {column: trace[start:start + chunk_steps] for column, trace in traces.items()}
+            pd.DataFrame(chunk).to_csv(f, index=False, header=start == 0)
+
+
+# Writes the traces of result into an uncompressed .npz. Deflating the float traces takes most of
+# the time of a save and barely shrinks the noisy ones, so the piecewise constant traces are
+# encoded instead: the reference and measured temperature as the starts and values of their
+# ChangePoints (name_starts, name_values) when they change rarely enough, the heater state as the
+# bytes of its PackedBits (heater_state_bits). The other traces keep their names.
+def write_npz(result, path):
+    arrays = {}
+    for name in COLUMNS:
+        trace = getattr(result, name)
+        if name in ('reference_temperature', 'measured_temperature'):
+            changes = ChangePoints()
+            changes.extend(trace)
+            if len(changes.starts) <= NPZ_MAX_CHANGES * len(trace):
+                arrays[name + '_starts'] = changes.starts
+                arrays[name + '_values'] = changes.values
+                continue
+        elif name == 'heater_state':
+            arrays[name + '_bits'] = np.packbits(np.asarray(trace, dtype=np.uint8))
+            continue
+        arrays[name] = trace
+    with open(path, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+# Reads the traces of an .npz written by write_npz
+def read_npz(path):
+    traces = {}
+    with np.load(path) as data:
+        length = len(data['time'])
+        for name in COLUMNS:
+            if name + '_starts' in data.files:
+                starts = data[name + '_starts']
+                traces[name] = np.repeat(data[name + '_values'], np.diff(np.append(starts, length)))
+            elif name + '_bits' in data.files:
+                traces[name] = np.unpackbits(data[name + '_bits'], count=length)
+            else:
+                traces[name] = data[name]
+    return SimulationResult.from_arrays(traces)
+
+
+def _arrow(extension):
+    try:
+        import pyarrow
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Saving and loading " + extension + " files needs pyarrow")
+    return pyarrow
+
+
+# Saves the traces of result in the format given by the extension of path: .csv, .npz, or .parquet
+# and .feather when pyarrow is installed. The binary formats are written from the trace arrays
+# without a DataFrame in between. Parquet and Feather name the columns like the attributes
+# (room_temperature, ...), see write_npz for the entries of an .npz.
+def save_result(result, path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".csv":
+        write_csv(result, path)
+    elif extension == ".npz":
+        write_npz(result, path)
+    elif extension in (".parquet", ".feather"):
+        pyarrow = _arrow(extension)
+        table = pyarrow.table({name: getattr(result, name) for name in COLUMNS})
+        if extension == ".parquet":
+            pyarrow.parquet.write_table(table, path)
+        else:
+            pyarrow.feather.write_feather(table, path)
+    else:
+        raise ValueError("Cannot save results as " + extension + ", use one of " + ", ".join(EXPORT_FORMATS))
+
+
+# Reads a file written by save_result back into a SimulationResult
+def load_result(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".csv":
+        df = pd.read_csv(path, float_precision="round_trip")
+        return SimulationResult.from_arrays({name: df[column].to_numpy() for name, column in COLUMNS.items()})
+    elif extension == ".npz":
+        return read_npz(path)
+    elif extension in (".parquet", ".feather"):
+        pyarrow = _arrow(extension)
+        if extension == ".parquet":
+            table = pyarrow.parquet.read_table(path)
+        else:
+            table = pyarrow.feather.read_table(path)
+        return SimulationResult.from_arrays({name: table.column(name).to_numpy() for name in COLUMNS})
+    raise ValueError("Cannot load results from " + extension + ", use one of " + ", ".join(EXPORT_FORMATS))
@@ -0,0 +1,181 @@
+import numpy as np
+from weather import date_to_hour
+
+
+DAY_NAMES = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+DAY_GROUPS = {"daily": range(7), "weekdays": range(5), "weekends": (5, 6)}
+DAY_SECONDS = 86400
+HOLIDAY = 7
+
+
+# Dates are either simulation dates like [2019, 'October', 6, 0] or anything np.datetime64 reads
+def _to_seconds(date):
+    if isinstance(date, (list, tuple)):
+        date = date_to_hour(date)
+    return int(np.datetime64(date, 's').astype(np.int64))
+
+
+def _to_day(date):
+    return _to_seconds(date) // DAY_SECONDS
+
+
+# Time of day as "07:30" or in hours
+def _time_of_day(time):
+    if isinstance(time, str):
+        hours, minutes = time.split(":")
+        return int(hours) * 3600 + int(minutes) * 60
+    return int(round(time * 3600))
+
+
+def _days(days):
+    if isinstance(days, str):
+        if days in DAY_GROUPS:
+            return set(DAY_GROUPS[days])
+        return {DAY_NAMES.index(day.strip()[:3].lower()) for day in days.split(",")}
+    return set(days)
+
+
+# Covers [start, end) within a day, a period ending before it starts runs over midnight
+def _covers(start, end, t):
+    if start < end:
+        return (t >= start) & (t < end)
+    return (t >= start) | (t < end)
+
+
+# Run-length encoding of a setpoint array as the first step of every run and its value
+def to_rle(setpoints):
+    starts = np.flatnonzero(np.diff(setpoints)) + 1
+    starts = np.insert(starts, 0, 0)
+    return starts, setpoints[starts]
+
+
+class Schedule:
+    # Setpoint program that compiles into one reference temperature per simulation step. A day
+    # follows the default temperature except where a period added with daily() covers it, holidays
+    # follow the periods added with holiday_period() instead, and override() replaces everything
+    # between two dates. Where periods overlap the one added last wins. Times are local like the
+    # weather data, e.g. Schedule(17).weekdays("07:00", "22:00", 21).holiday([2019, 'December', 25, 0])
+    def __init__(self, default=20):
+        self.default = default
+        self.periods = []
+        self.holiday_periods = []
+        self.holidays = []
+        self.overrides = []
+        self._compiled = {}
+
+    # The compiled arrays are not pickled, every sweep worker compiles its own copy once
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_compiled"] = {}
+        return state
+
+    def _changed(self):
+        self._compiled = {}
+        return self
+
+    # days is "daily", "weekdays", "weekends", day names like "mon,wed" or weekday numbers (Monday 0)
+    def daily(self, start, end, temperature, days="daily"):
+        self.periods.append((_days(days), _time_of_day(start), _time_of_day(end), temperature))
+        return self._changed()
+
+    def weekdays(self, start, end, temperature):
+        return self.daily(start, end, temperature, "weekdays")
+
+    def weekends(self, start, end, temperature):
+        return self.daily(start, end, temperature, "weekends")
+
+    def holiday(self, *dates):
+        self.holidays.extend(_to_day(date) for date in dates)
+        return self._changed()
+
+    def holiday_period(self, start, end, temperature):
+        self.holiday_periods.append((_time_of_day(start), _time_of_day(end), temperature))
+        return self._changed()
+
+    def override(self, start_date, end_date, temperature):
+        self.overrides.append((_to_seconds(start_date), _to_seconds(end_date), temperature))
+        return self._changed()
+
+    # Every temperature the schedule can set, e.g. for the limits of a plot
+    def temperatures(self):
+        return [self.default] + [p[-1] for p in self.periods + self.holiday_periods + self.overrides]
+
+    # Seconds of the day where the setpoint of a weekday (or HOLIDAY) can change and its value there
+    def _profile(self, day):
+        if day == HOLIDAY:
+            periods = self.holiday_periods
+        else:
+            periods = [period[1:] for period in self.periods if day in period[0]]
+        offsets = np.unique([0] + [t for period in periods for t in period[:2] if t < DAY_SECONDS])
+        values = np.full(len(offsets), self.default, dtype=float)
+        for start, end, temperature in periods:
+            values[_covers(start, end, offsets)] = temperature
+        return offsets, values
+
+    # Setpoint of every step of a run of sim_len steps of step_size seconds starting at start_date.
+    # The daily programs are laid out over all days of the run as breakpoints, which become runs of
+    # steps expanded with np.repeat, so a year at 15 s steps compiles in milliseconds. The result is
+    # cached and read only, simulations sharing the schedule share the array.
+    def compile(self, start_date, step_size, sim_len):
+        t0 = _to_seconds(start_date)
+        key = (t0, step_size, sim_len)
+        if key in self._compiled:
+            return self._compiled[key]
+
+        days = np.arange(t0 // DAY_SECONDS, (t0 + (sim_len - 1) * step_size) // DAY_SECONDS + 1)
+        # 1970-01-01 was a Thursday
+        programs = np.where(np.isin(days, self.holidays), HOLIDAY, (days + 3) % 7)
+        times = []
+        values = []
+        for program in np.unique(programs):
+            offsets, temperatures = self._profile(program)
+            program_days = days[programs == program]
+            times.append((program_days[:, None] * DAY_SECONDS + offsets).ravel())
+            values.append(np.tile(temperatures, len(program_days)))
+        times = np.concatenate(times)
+        values = np.concatenate(values)
+        order = np.argsort(times, kind='stable')
+
+        # A breakpoint takes effect at the first step at or after it
+        first_steps = np.clip(np.ceil((times[order] - t0) / step_size), 0, sim_len).astype(int)
+        setpoints = np.repeat(values[order], np.diff(np.append(first_steps, sim_len)))
+        for start, end, temperature in self.overrides:
+            first = int(np.clip(np.ceil((start - t0) / step_size), 0, sim_len))
+            last = int(np.clip(np.ceil((end - t0) / step_size), 0, sim_len))
+            setpoints[first:last] = temperature
+
+        setpoints.flags.writeable = False
+        self._compiled[key] = setpoints
+        return setpoints
+
+    def compile_rle(self, start_date, step_size, sim_len):
+        return to_rle(self.compile(start_date, step_size, sim_len))
+
+    # Reads a schedule written as entries separated by ";", e.g.
+    # "17; weekdays 07:00-22:00 21; weekends 09:00-23:00 20; holiday 2019-12-25;
+    #  override 2019-12-24T00 2020-01-02T00 16"
+    # A bare number is the default, holidays follows the holiday program and days is any of
+    # daily, weekdays, weekends or day names like mon,wed,fri.
+    @classmethod
+    def parse(cls, text):
+        schedule = cls()
+        for entry in text.split(";"):
+            words = entry.split()
+            try:
+                if len(words) == 1:
+                    schedule.default = float(words[0])
+                elif words[0] == "holiday":
+                    schedule.holiday(*"".join(words[1:]).split(","))
+                elif words[0] == "override" and len(words) == 4:
+                    schedule.override(words[1], words[2], float(words[3]))
+                elif len(words) == 3:
+                    start, end = words[1].split("-")
+                    if words[0] == "holidays":
+                        schedule.holiday_period(start, end, float(words[2]))
+                    else:
+                        schedule.daily(start, end, float(words[2]), words[0])
+                elif words:
+                    raise ValueError(entry)
+            except ValueError:
+                raise ValueError("Cannot read schedule entry: " + entry.strip())
+        return schedule._changed()
@@ -0,0 +1,81 @@
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+from Simulator import Simulation
+from noise import spawn_seeds
+from profiling import PhaseStats
+
+
+# Keys of a run spec that are passed to Simulation.run_sim, every other key goes to Simulation
+RUN_ARGS = {"initial_temp": 20, "measure_freq": 15, "control_freq": 60, "mode": "step"}
+
+
+# List of run specs over the cartesian product of the given values, e.g.
+# make_grid(K=[20, 30], P=[0.5, 1, 2], control_freq=[30, 60]) gives 12 specs
+def make_grid(**axes):
+    names = list(axes)
+    return [dict(zip(names, values)) for values in itertools.product(*axes.values())]
+
+
+# Metrics of one run, with its run time and, if profile is set, the time of every phase of the run
+# as "time <phase>" (see profiling.PhaseStats)
+def run_spec(spec, seed=None, profile=False):
+    sim_args = {key: value for key, value in spec.items() if key not in RUN_ARGS}
+    sim_args.setdefault("seed", seed)
+    run_args = {key: spec.get(key, default) for key, default in RUN_ARGS.items()}
+    stats = PhaseStats() if profile else None
+    start = time.perf_counter()
+    metrics = Simulation(**sim_args).run_sim(record="summary", stats=stats, **run_args)
+    metrics["run_time"] = time.perf_counter() - start
+    if stats is not None:
+        for phase, row in stats.summary().items():
+            metrics["time " + phase] = row["seconds"]
+    return metrics
+
+
+class Sweep:
+    # Runs a list of run specs (Simulation keywords plus the run_sim keywords in RUN_ARGS) on a pool
+    # of worker processes, one per core by default. Iterating over a Sweep yields
+    # (index, spec, metrics) as soon as each run finishes; run() gathers everything into one table.
+    # cancel() drops the runs that have not started yet and stops the iteration, runs already in a
+    # worker are left to finish.
+    # Every run without a seed of its own gets the child seed spawn_seeds(seed, len(specs))[index],
+    # so a sweep with a fixed seed gives the same table however the runs land on the workers.
+    # With profile set every run also reports the time of its phases.
+    def __init__(self, specs, max_workers=None, seed=None, profile=False):
+        self.specs = list(specs)
+        self.profile = profile
+        self.max_workers = max_workers or os.cpu_count()
+        self.seeds = spawn_seeds(seed, len(self.specs))
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def __iter__(self):
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(run_spec, spec, self.seeds[i], self.profile): i for i, spec in enumerate(self.specs)}
+            try:
+                for future in as_completed(futures):
+                    if self.cancelled.is_set():
+                        break
+                    i = futures[future]
+                    yield i, self.specs[i], future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def run(self, callback=None):
+        rows = {}
+        for i, spec, metrics in self:
+            rows[i] = {**spec, **metrics}
+            if callback is not None:
+                callback(i, spec, metrics)
+        return pd.DataFrame([rows[i] for i in sorted(rows)], index=sorted(rows))
+
+
+def run_sweep(specs, max_workers=None, callback=None, seed=None):
+    return Sweep(specs, max_workers, seed).run(callback)
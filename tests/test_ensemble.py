@@ -0,0 +1,22 @@
+import numpy as np
+import pandas as pd
+from ensemble import PERCENTILES, EnsembleResult
+
+
+def test_decimated_bands_cover_the_bands():
+    rng = np.random.default_rng(0)
+    n = 10007
+    room = rng.normal(size=(20, n)).cumsum(axis=1)
+    bands = np.percentile(room, PERCENTILES, axis=0)
+    time = np.arange(n) / 240
+    ensemble = EnsembleResult(time, np.zeros(n), np.zeros(n), PERCENTILES, bands, pd.DataFrame())
+    decimated = ensemble.decimate(100)
+    assert len(decimated) <= 202
+    assert decimated.bands.shape == (len(PERCENTILES), len(decimated))
+    assert decimated.time[0] == time[0] and decimated.time[-1] == time[-1]
+    # Every original sample lies within the band of the bucket it falls in
+    bucket = np.searchsorted(decimated.time, time, side='right') - 1
+    for i in range(len(PERCENTILES) // 2):
+        assert np.all(decimated.bands[i][bucket] <= bands[i])
+        assert np.all(decimated.bands[-1 - i][bucket] >= bands[-1 - i])
+    assert ensemble.decimate(n) is ensemble
@@ -0,0 +1,38 @@
+import pytest
+from Simulator import Simulation
+from profiling import PhaseStats
+
+
+def assert_shares(stats):
+    shares = [row["share"] for row in stats.summary().values()]
+    assert all(0 <= share <= 1 for share in shares)
+    assert sum(shares) == pytest.approx(1)
+
+
+def test_outlier_is_not_scaled_up():
+    stats = PhaseStats(sample_every=64)
+    stats.clock_overhead = 0.0
+    stats.add_samples("update_temp", [1e-6] * 99 + [1e-2], 6400)
+    stats.add("control", 1e-3, 100)
+    stats.wall_time = 0.02
+    assert stats.seconds("update_temp") == pytest.approx(6400e-6)
+    assert_shares(stats)
+
+
+def test_estimates_above_wall_time_are_scaled_down():
+    stats = PhaseStats()
+    stats.clock_overhead = 0.0
+    stats.add_samples("update_temp", [1e-3], 100)
+    stats.add("control", 0.1)
+    stats.wall_time = 0.1
+    assert stats.summary()["other"]["seconds"] == 0
+    assert_shares(stats)
+
+
+@pytest.mark.parametrize("mode", ["step", "event"])
+def test_run_shares(mode):
+    stats = PhaseStats()
+    sim = Simulation(start_date=[2019, 'October', 6, 0], end_date=[2019, 'October', 13, 0], step_size=15, seed=3)
+    sim.run_sim(20, 5, 10, mode=mode, record="summary", stats=stats)
+    assert stats.wall_time > 0
+    assert_shares(stats)
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from Simulator import Simulation
+from results import COLUMNS, SimulationResult, load_result, save_result
+
+
+@pytest.fixture(scope="module")
+def result():
+    sim = Simulation(start_date=[2019, 'October', 6, 0], end_date=[2019, 'October', 8, 0], step_size=15, seed=3)
+    return sim.run_sim(20, 5, 10)
+
+
+def assert_same_traces(loaded, result):
+    assert len(loaded) == len(result)
+    for name in COLUMNS:
+        np.testing.assert_array_equal(getattr(loaded, name), getattr(result, name))
+
+
+@pytest.mark.parametrize("extension", [".csv", ".npz"])
+def test_round_trip_is_exact(tmp_path, result, extension):
+    path = str(tmp_path / ("result" + extension))
+    save_result(result, path)
+    assert_same_traces(load_result(path), result)
+
+
+@pytest.mark.parametrize("extension", [".parquet", ".feather"])
+def test_arrow_round_trip_is_exact(tmp_path, result, extension):
+    pytest.importorskip("pyarrow")
+    path = str(tmp_path / ("result" + extension))
+    save_result(result, path)
+    assert_same_traces(load_result(path), result)
+
+
+def test_npz_keeps_traces_that_change_every_step(tmp_path, result):
+    traces = {name: getattr(result, name) for name in COLUMNS}
+    traces['measured_temperature'] = traces['room_temperature'] + np.random.default_rng(0).normal(size=len(result))
+    result = SimulationResult.from_arrays(traces)
+    path = str(tmp_path / "result.npz")
+    save_result(result, path)
+    with np.load(path) as data:
+        assert "measured_temperature" in data.files
+        assert "reference_temperature_starts" in data.files
+    assert_same_traces(load_result(path), result)
+
+
+def test_unknown_extension(tmp_path, result):
+    with pytest.raises(ValueError):
+        save_result(result, str(tmp_path / "result.txt"))
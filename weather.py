@@ -0,0 +1,113 @@
+import os
+import numpy as np
+import pandas as pd
+
+
+WEATHER_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Edmonton Year Long Temperature.csv")
+MONTH_DICT = {'January': "01",
+              'February': "02",
+              'March': "03",
+              'April': "04",
+              'May': "05",
+              'June': "06",
+              'July': "07",
+              'August': "08",
+              'September': "09",
+              'October': "10",
+              'November': "11",
+              'December': "12"}
+
+
+class WeatherData:
+    # Hourly temperatures of a weather csv in the row order of the csv, which is newest first. The csv
+    # is parsed once into a binary cache next to it (the temperatures and the hour of every row) and
+    # later loads memory-map the cache, so processes using the same data share its pages.
+    def __init__(self, csv_path=WEATHER_CSV):
+        self.csv_path = csv_path
+        stem = os.path.splitext(csv_path)[0]
+        self.temperature_path = stem + ".temperature.npy"
+        self.hours_path = stem + ".hours.npy"
+        self._rows = None
+
+        if not self.is_cached():
+            temperature, hours = self.parse_csv()
+            if not self.write_cache(temperature, hours):
+                self.temperature = temperature
+                self.hours = hours
+                return
+        self.temperature = np.asarray(np.load(self.temperature_path, mmap_mode='r'))
+        self.hours = np.asarray(np.load(self.hours_path, mmap_mode='r'))
+
+    def is_cached(self):
+        csv_time = os.path.getmtime(self.csv_path)
+        return all(os.path.exists(path) and os.path.getmtime(path) >= csv_time
+                   for path in (self.temperature_path, self.hours_path))
+
+    def parse_csv(self):
+        table = pd.read_csv(self.csv_path)
+        temperature = table["Temperature"].to_numpy(dtype=float)
+        hours = pd.to_datetime(table["Date"].str[:19]).to_numpy().astype('datetime64[h]')
+        return temperature, hours
+
+    # The cache files are written under a temporary name and moved into place, so a process never
+    # maps a half written file. Returns False if the directory is not writable.
+    def write_cache(self, temperature, hours):
+        try:
+            for path, data in ((self.temperature_path, temperature), (self.hours_path, hours)):
+                tmp_path = path + "." + str(os.getpid()) + ".tmp"
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, data)
+                os.replace(tmp_path, path)
+        except OSError:
+            return False
+        return True
+
+    # The hours are local time, so one hour repeats when the clocks fall back and one is missing when
+    # they spring forward. A repeated hour maps to its first row.
+    def get_row(self, date_hour):
+        if self._rows is None:
+            hours = self.hours[::-1].astype(np.int64).tolist()
+            self._rows = dict(zip(hours, range(len(hours) - 1, -1, -1)))
+        index = self._rows.get(int(date_hour.astype(np.int64)))
+        if index is None:
+            raise ValueError("No weather data for " + str(date_hour) + ", the data covers "
+                             + str(self.hours[-1]) + " to " + str(self.hours[0]))
+        return index
+
+
+_WEATHER = {}
+
+
+# The weather data is only loaded the first time it is needed
+def get_weather(csv_path=WEATHER_CSV):
+    if csv_path not in _WEATHER:
+        _WEATHER[csv_path] = WeatherData(csv_path)
+    return _WEATHER[csv_path]
+
+
+def get_temperatures():
+    return get_weather().temperature
+
+
+def get_years():
+    hours = get_weather().hours
+    return list(range(hours.min().astype(object).year, hours.max().astype(object).year + 1))
+
+
+# Date is a list in the form [Year, Month, Day, Hhour]
+def convert_date(date):
+    year, month, day, hour = date
+    cvt_month = MONTH_DICT[month]
+    cvt_day = str(day).zfill(2)
+    cvt_hour = str(hour).zfill(2)
+    return str(year) + "-" + cvt_month + "-" + cvt_day + " " + cvt_hour + ":00:00 MDT"
+
+
+def date_to_hour(date):
+    year, month, day, hour = date
+    return np.datetime64(str(year) + "-" + MONTH_DICT[month] + "-" + str(day).zfill(2)
+                         + "T" + str(hour).zfill(2), 'h')
+
+
+def get_date_index(date):
+    return get_weather().get_row(date_to_hour(date))
@@ -0,0 +1,174 @@
+import multiprocessing
+import time
+import traceback
+from ensemble import run_lockstep
+from noise import spawn_seeds
+from profiling import PhaseStats
+from progress import ProgressToken
+from results import MemmapSimulationResult, SharedSimulationResult
+
+
+# Seconds between two progress messages of a job, about the refresh rate of the GUI
+PROGRESS_INTERVAL = 0.05
+
+# Steps the runs of the worker copy into the result at a time
+CHUNK_STEPS = 1000
+
+# Buckets the ensemble bands are reduced to before they are sent, more than any plot is pixels wide
+ENSEMBLE_BUCKETS = 4096
+
+
+class SimulationWorker:
+    # A process that runs the simulations and calibrations of the GUI, so their stepping loops do
+    # not hold the GIL of the Tk main loop. sim_class is the Simulation class of the GUI, it is
+    # pickled by reference and imported again in the worker. One job runs at a time: run() and
+    # calibrate() hand a job over and return its ProgressToken, whose cancel() stops it. The traces
+    # of a run go straight into the result passed to run(), a SharedSimulationResult or a
+    # MemmapSimulationResult, everything else comes back as messages that poll() returns:
+    #     ("progress", fraction, length)   length is the steps of the result filled so far, or
+    #                                      None for a calibration
+    #     ("done", kind, payload)          kind is "run" or "calibrate", see _run and _calibrate
+    #     ("error", kind, traceback)
+    # The worker is started with "spawn", which is safe next to a running Tk and works on every
+    # platform. It is a daemon and ends with the GUI. Should it die during a job, poll() reports
+    # an error for the job and a new worker is started.
+    def __init__(self, sim_class):
+        self.sim_class = sim_class
+        self.kind = None
+        self._start()
+
+    def _start(self):
+        context = multiprocessing.get_context("spawn")
+        self.conn, worker_conn = context.Pipe()
+        self.process = context.Process(target=serve, args=(worker_conn, self.sim_class), daemon=True)
+        self.process.start()
+        worker_conn.close()
+
+    # Runs sim_class(**sim_args) into result, then num_members more as an ensemble.run_lockstep
+    # ensemble whose member m is seeded with spawn_seeds(seed, num_members)[m]. With profile set the
+    # done message carries the PhaseStats table of the run.
+    def run(self, result, sim_args, num_members, initial_temp, measure_freq, control_freq, profile=False,
+            seed=None):
+        return self._submit("run", "Simulating...",
+                            (result, sim_args, num_members, initial_temp, measure_freq, control_freq, profile,
+                             seed))
+
+    def calibrate(self, sim_args, control_freq):
+        return self._submit("calibrate", "Calibrating...", (sim_args, control_freq))
+
+    def _submit(self, kind, text, args):
+        token = ProgressToken(text, shared=True)
+        self.kind = kind
+        self.conn.send((kind, token, args))
+        return token
+
+    # The messages that arrived since the last call, never blocks
+    def poll(self):
+        messages = []
+        try:
+            while self.conn.poll():
+                messages.append(self.conn.recv())
+        except (EOFError, OSError):
+            self.process.join(1)
+            if self.kind is not None:
+                messages.append(("error", self.kind, "The worker process ended with exit code "
+                                 + str(self.process.exitcode)))
+            self._start()
+        if messages and messages[-1][0] != "progress":
+            self.kind = None
+        return messages
+
+    # Ends the worker once its job is done, the caller cancels the job first. A worker that does not
+    # end in time is terminated. Closing again does nothing.
+    def close(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
+
+
+class _PipeProgress:
+    # Stands in for the ProgressToken of a job inside the worker. Cancellation is read from the
+    # token, progress is sent over the pipe, at most every PROGRESS_INTERVAL seconds.
+    def __init__(self, conn, token, result=None):
+        self.conn = conn
+        self.token = token
+        self.result = result
+        self.last_sent = 0.0
+
+    @property
+    def fraction(self):
+        return self.token.fraction
+
+    @property
+    def cancelled(self):
+        return self.token.cancelled
+
+    def update(self, done, total):
+        cancelled = self.token.update(done, total)
+        if time.perf_counter() - self.last_sent >= PROGRESS_INTERVAL:
+            self.send()
+        return cancelled
+
+    def send(self):
+        self.last_sent = time.perf_counter()
+        self.conn.send(("progress", self.token.fraction, None if self.result is None else len(self.result)))
+
+
+# Returns the steps filled, the ensemble.EnsembleResult decimated to ENSEMBLE_BUCKETS (None without
+# members or when cancelled) and the profile table (None without profile). The full resolution
+# bands of a long run would take seconds to pickle and to receive on the Tk thread.
+def _run(conn, sim_class, token, result, sim_args, num_members, initial_temp, measure_freq, control_freq,
+         profile, seed):
+    progress = _PipeProgress(conn, token, result)
+    stats = PhaseStats() if profile else None
+    sim = sim_class(**sim_args)
+    for chunk in sim.iter_run(initial_temp=initial_temp,
+                              measure_freq=measure_freq,
+                              control_freq=control_freq,
+                              chunk_steps=CHUNK_STEPS,
+                              stats=stats,
+                              progress=progress):
+        result.extend(chunk)
+    if isinstance(result, MemmapSimulationResult):
+        result.flush()
+    progress.send()
+
+    ensemble = None
+    if num_members and not token.cancelled:
+        members = [sim_class(seed=member_seed, **sim_args) for member_seed in spawn_seeds(seed, num_members)]
+        ensemble = run_lockstep(members, initial_temp, measure_freq, control_freq, chunk_steps=CHUNK_STEPS,
+                                progress=progress)
+        ensemble = None if token.cancelled else ensemble.decimate(ENSEMBLE_BUCKETS)
+    return {"length": len(result), "ensemble": ensemble, "stats": None if stats is None else stats.format()}
+
+
+# Returns the calibrated [P, I, D]
+def _calibrate(conn, sim_class, token, sim_args, control_freq):
+    return sim_class(**sim_args).calibrate(control_freq, _PipeProgress(conn, token))
+
+
+# Main loop of the worker process, runs the jobs sent by SimulationWorker until it sends None
+def serve(conn, sim_class):
+    jobs = {"run": _run, "calibrate": _calibrate}
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        kind, token, args = job
+        try:
+            conn.send(("done", kind, jobs[kind](conn, sim_class, token, *args)))
+        except Exception:
+            conn.send(("error", kind, traceback.format_exc()))
+        finally:
+            token.close()
+            if kind == "run" and isinstance(args[0], SharedSimulationResult):
+                args[0].close()